@@ -0,0 +1,370 @@
+"""
+CCA Folder Processor - benchmarks
+
+Builds reproducible synthetic source trees and times SIP creation and
+description on them. Results are saved as JSON so that runs from different
+versions can be compared:
+
+    python3 benchmark.py --output before.json
+    python3 benchmark.py --output after.json --compare before.json
+
+The batch benchmark runs the full pipeline and so needs Brunnhilde and
+Siegfried, as SIP creation does. The stats benchmark times the description
+statistics (dfxml_file_stats and SIPStats) on one large synthetic DFXML
+file, with a million fileobjects at scale 1.
+
+(c) Canadian Centre for Architecture
+MIT License
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from processor import (
+    VERSION,
+    DescriptionWriter,
+    SIPProcessor,
+    SIPStats,
+    copy_tree,
+    dfxml_file_stats,
+    scan_tree,
+    write_dfxml,
+)
+
+CORPORA = ("tiny", "huge", "deep", "wide")
+BENCHMARKS = ("copy", "dfxml", "batch", "describe", "stats")
+
+# Fileobjects in the stats benchmark's DFXML file at scale 1.
+STATS_FILEOBJECTS = 1000000
+
+DFXML_NAMESPACE = "http://www.forensicswiki.org/wiki/Category:Digital_Forensics_XML"
+
+# Modification times given to synthetic files: 2000-01-01 to 2020-01-01.
+MTIME_RANGE = (946684800, 1577836800)
+
+
+def _random_bytes(rng, size):
+    return rng.getrandbits(size * 8).to_bytes(size, "little") if size else b""
+
+
+def _write_file(rng, path, size, block=None):
+    with open(path, "wb") as f:
+        if block is None:
+            f.write(_random_bytes(rng, size))
+        else:
+            # Vary each block so that large files do not deduplicate.
+            written = 0
+            counter = 0
+            while written < size:
+                chunk = counter.to_bytes(8, "little") + block[8:]
+                chunk = chunk[: size - written]
+                f.write(chunk)
+                written += len(chunk)
+                counter += 1
+    mtime = rng.randint(*MTIME_RANGE)
+    os.utime(path, (mtime, mtime))
+
+
+def build_corpus(kind, root, scale=1.0, seed=0):
+    """Build synthetic corpus of the given kind in root.
+
+    Return list of source folders, each of which becomes one SIP:
+
+    - tiny: folders of many small files.
+    - huge: folders holding a few large files.
+    - deep: one deeply nested folder.
+    - wide: many sibling folders of a few files each.
+
+    The same kind, scale and seed always produce the same tree.
+    """
+    rng = random.Random("{}-{}".format(kind, seed))
+    os.makedirs(root)
+    folders = []
+
+    def folder(name):
+        path = os.path.join(root, name)
+        os.makedirs(path)
+        folders.append(path)
+        return path
+
+    if kind == "tiny":
+        for i in range(10):
+            path = folder("tiny_{:03d}".format(i))
+            for j in range(max(1, int(1000 * scale))):
+                _write_file(
+                    rng,
+                    os.path.join(path, "f{:05d}.txt".format(j)),
+                    rng.randint(0, 512),
+                )
+    elif kind == "huge":
+        block = _random_bytes(rng, 1024 * 1024)
+        for i in range(2):
+            path = folder("huge_{:03d}".format(i))
+            for j in range(2):
+                size = max(1, int(256 * 1024 * 1024 * scale))
+                _write_file(rng, os.path.join(path, "f{}.bin".format(j)), size, block)
+    elif kind == "deep":
+        path = folder("deep_000")
+        for depth in range(max(1, int(50 * scale))):
+            for j in range(10):
+                _write_file(
+                    rng, os.path.join(path, "f{}.txt".format(j)), rng.randint(0, 4096)
+                )
+            path = os.path.join(path, "level_{:03d}".format(depth))
+            os.makedirs(path)
+    elif kind == "wide":
+        for i in range(max(1, int(500 * scale))):
+            path = folder("wide_{:05d}".format(i))
+            for j in range(2):
+                _write_file(
+                    rng, os.path.join(path, "f{}.txt".format(j)), rng.randint(0, 4096)
+                )
+    else:
+        raise ValueError("Unknown corpus: {}".format(kind))
+    return folders
+
+
+def write_synthetic_dfxml(path, fileobjects, seed=0):
+    """Write DFXML file describing fileobjects synthetic files.
+
+    The file is written as text, one fileobject at a time, so that writing
+    it takes little memory however many fileobjects it has.
+    """
+    rng = random.Random("dfxml-{}".format(seed))
+    with open(path, "w") as f:
+        f.write(
+            '<?xml version="1.0"?>\n<dfxml xmlns="{}" version="1.1.1">\n'.format(
+                DFXML_NAMESPACE
+            )
+        )
+        for i in range(fileobjects):
+            name = "src/{:04d}/f{:07d}.txt".format(i // 1000, i)
+            f.write(
+                "<fileobject><filename>{}</filename><name_type>r</name_type>"
+                "<filesize>{}</filesize><mtime>{}</mtime>"
+                '<hashdigest type="md5">{}</hashdigest></fileobject>\n'.format(
+                    name,
+                    rng.randint(0, 1024 * 1024),
+                    time.strftime(
+                        "%Y-%m-%dT%H:%M:%SZ", time.gmtime(rng.randint(*MTIME_RANGE))
+                    ),
+                    hashlib.md5(name.encode()).hexdigest(),
+                )
+            )
+        f.write("</dfxml>\n")
+
+
+def run_stats(work_dir, fileobjects, seed, trace_memory):
+    """Time description statistics for a large DFXML file. Return result."""
+    dfxml_path = os.path.join(work_dir, "stats.xml")
+    write_synthetic_dfxml(dfxml_path, fileobjects, seed)
+    entry = {"corpus": "synthetic", "benchmark": "stats", "sips": 1}
+    with measure(entry, trace_memory):
+        stats = SIPStats()
+        for name_type, mtime, filesize in dfxml_file_stats(dfxml_path):
+            stats.add(name_type, mtime, filesize)
+    entry.update(files=stats.file_count, bytes=stats.total_bytes)
+    os.remove(dfxml_path)
+    return entry
+
+
+@contextlib.contextmanager
+def measure(result, trace_memory=False):
+    """Record wall time, and peak Python memory if tracing, in result."""
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        yield result
+    finally:
+        result["seconds"] = round(time.perf_counter() - start, 3)
+        if trace_memory:
+            result["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1000000, 1)
+            tracemalloc.stop()
+
+
+def run_corpus(
+    kind, work_dir, benchmarks, scale, seed, workers, bag_files, trace_memory
+):
+    """Run benchmarks on one corpus and return list of result dicts."""
+    corpus_dir = os.path.join(work_dir, kind)
+    folders = build_corpus(kind, corpus_dir, scale, seed)
+    results = []
+
+    def result(name):
+        entry = {"corpus": kind, "benchmark": name, "sips": len(folders)}
+        results.append(entry)
+        return entry
+
+    if "copy" in benchmarks:
+        copy_dir = os.path.join(work_dir, "copy")
+        with measure(result("copy"), trace_memory) as entry:
+            files = size = 0
+            for path in folders:
+                name = os.path.basename(path)
+                for record in copy_tree(path, os.path.join(copy_dir, name), name):
+                    if record.name_type == "r":
+                        files += 1
+                        size += record.size
+        entry.update(files=files, bytes=size)
+        shutil.rmtree(copy_dir)
+
+    if "dfxml" in benchmarks:
+        dfxml_path = os.path.join(work_dir, "dfxml.xml")
+        with measure(result("dfxml"), trace_memory) as entry:
+            for path in folders:
+                name = os.path.basename(path)
+                write_dfxml(scan_tree(path, name, workers=workers), dfxml_path)
+                stats = SIPStats()
+                for name_type, mtime, filesize in dfxml_file_stats(dfxml_path):
+                    stats.add(name_type, mtime, filesize)
+        os.remove(dfxml_path)
+
+    output_dir = os.path.join(work_dir, "output")
+    sips = os.path.join(output_dir, "SIPs")
+    if "batch" in benchmarks or "describe" in benchmarks:
+        os.makedirs(sips)
+        processor = SIPProcessor(
+            folders, sips, bag_files, False, output_dir, workers=workers
+        )
+        with measure(result("batch"), trace_memory) as entry:
+            processor.run()
+        entry["stages"] = processor.metrics.summary()
+
+    if "describe" in benchmarks:
+        # Describe each SIP from its reports, as when resuming a batch.
+        description = DescriptionWriter(
+            os.path.join(output_dir, "description.csv"), bag_files
+        )
+        with measure(result("describe"), trace_memory):
+            for name in sorted(os.listdir(sips)):
+                description.add(os.path.join(sips, name))
+
+    shutil.rmtree(corpus_dir)
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    return results
+
+
+def compare(results, baseline):
+    """Return lines comparing results with baseline results."""
+    old = {(r["corpus"], r["benchmark"]): r for r in baseline["results"]}
+    lines = []
+    for entry in results:
+        line = "{:6} {:9} {:9.3f} s".format(
+            entry["corpus"], entry["benchmark"], entry["seconds"]
+        )
+        previous = old.get((entry["corpus"], entry["benchmark"]))
+        if previous and previous["seconds"]:
+            line += "  {:6.2f}x baseline".format(entry["seconds"] / previous["seconds"])
+        lines.append(line)
+    return lines
+
+
+def _make_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the SIP pipeline.")
+    parser.add_argument(
+        "-c",
+        "--corpus",
+        help="Corpus to run (default: all)",
+        choices=CORPORA,
+        action="append",
+    )
+    parser.add_argument(
+        "-b",
+        "--benchmark",
+        help="Benchmark to run (default: all)",
+        choices=BENCHMARKS,
+        action="append",
+    )
+    parser.add_argument(
+        "-s",
+        "--scale",
+        help="Multiply corpus sizes by this factor (default: 1)",
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument("--seed", help="Corpus seed (default: 0)", type=int, default=0)
+    parser.add_argument(
+        "-w", "--workers", help="Parallel SIPs (default: 1)", type=int, default=1
+    )
+    parser.add_argument("--bag", help="Create SIPs as bags", action="store_true")
+    parser.add_argument(
+        "-m",
+        "--memory",
+        help="Trace peak Python memory (slows benchmarks down)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--work-dir", help="Directory for corpora and SIPs (default: a temp dir)"
+    )
+    parser.add_argument("-o", "--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Compare with results in this JSON file")
+    return parser
+
+
+def main(argv=None):
+    args = _make_parser().parse_args(argv)
+    corpora = args.corpus or CORPORA
+    benchmarks = args.benchmark or BENCHMARKS
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        if "stats" in benchmarks:
+            results.append(
+                run_stats(
+                    work_dir,
+                    max(1, int(STATS_FILEOBJECTS * args.scale)),
+                    args.seed,
+                    args.memory,
+                )
+            )
+        for kind in corpora:
+            results.extend(
+                run_corpus(
+                    kind,
+                    work_dir,
+                    benchmarks,
+                    args.scale,
+                    args.seed,
+                    args.workers,
+                    args.bag,
+                    args.memory,
+                )
+            )
+
+    report = {
+        "version": VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "options": {
+            "scale": args.scale,
+            "seed": args.seed,
+            "workers": args.workers,
+            "bag": args.bag,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    baseline = {"results": []}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print("\n".join(compare(results, baseline)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
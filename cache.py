@@ -0,0 +1,157 @@
+"""
+CCA Folder Processor - persistent file cache
+
+SQLite cache of per-file digests and Siegfried identifications, so that
+reprocessing a folder only hashes and identifies new or changed files.
+
+(c) Canadian Centre for Architecture
+MIT License
+"""
+import json
+import sqlite3
+import threading
+import time
+
+DIGEST_COLUMNS = ("md5", "sha256", "sha512")
+
+# Default eviction limits applied by DigestCache.evict.
+MAX_AGE_DAYS = 180
+MAX_ENTRIES = 10000000
+
+
+class DigestCache(object):
+    """Cache of file digests and Siegfried CSV rows.
+
+    Entries are keyed by source path and are only used while the file's
+    size, mtime and inode are unchanged. Writes are batched until commit is
+    called. The cache can be shared between threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                md5 TEXT,
+                sha256 TEXT,
+                sha512 TEXT,
+                siegfried TEXT,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS files_last_used ON files (last_used)"
+        )
+        self.conn.commit()
+
+    def _lookup(self, path, stat_result, columns):
+        row = self.conn.execute(
+            "SELECT {} FROM files WHERE path = ? AND size = ? AND mtime_ns = ? "
+            "AND inode = ?".format(", ".join(columns)),
+            (path, stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino),
+        ).fetchone()
+        if row is not None:
+            self.conn.execute(
+                "UPDATE files SET last_used = ? WHERE path = ?", (time.time(), path)
+            )
+        return row
+
+    def _upsert(self, path, stat_result):
+        # Drop cached values if the file has changed since they were stored.
+        self.conn.execute(
+            "DELETE FROM files WHERE path = ? AND NOT (size = ? AND mtime_ns = ? "
+            "AND inode = ?)",
+            (path, stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino),
+        )
+        self.conn.execute(
+            "INSERT OR IGNORE INTO files (path, size, mtime_ns, inode, last_used) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (
+                path,
+                stat_result.st_size,
+                stat_result.st_mtime_ns,
+                stat_result.st_ino,
+                time.time(),
+            ),
+        )
+
+    def get_digests(self, path, stat_result, algorithms):
+        """Return dict of cached digests for file, or None.
+
+        None is returned unless every algorithm requested is cached.
+        """
+        with self.lock:
+            row = self._lookup(path, stat_result, DIGEST_COLUMNS)
+        if row is None:
+            return None
+        digests = dict(zip(DIGEST_COLUMNS, row))
+        if not all(digests.get(algorithm) for algorithm in algorithms):
+            return None
+        return {algorithm: digests[algorithm] for algorithm in algorithms}
+
+    def put_digests(self, path, stat_result, digests):
+        """Store digests for file."""
+        with self.lock:
+            self._upsert(path, stat_result)
+            for algorithm in DIGEST_COLUMNS:
+                if digests.get(algorithm):
+                    self.conn.execute(
+                        "UPDATE files SET {} = ? WHERE path = ?".format(algorithm),
+                        (digests[algorithm], path),
+                    )
+
+    def get_siegfried(self, path, stat_result):
+        """Return cached Siegfried CSV rows (dicts) for file, or None."""
+        with self.lock:
+            row = self._lookup(path, stat_result, ("siegfried",))
+        if row is None or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+    def put_siegfried(self, path, stat_result, sf_rows):
+        """Store Siegfried CSV rows (dicts) for file.
+
+        A file has more than one row when it is an archive scanned with -z.
+        """
+        with self.lock:
+            self._upsert(path, stat_result)
+            self.conn.execute(
+                "UPDATE files SET siegfried = ? WHERE path = ?",
+                (json.dumps(sf_rows), path),
+            )
+
+    def commit(self):
+        """Write pending changes to disk."""
+        with self.lock:
+            self.conn.commit()
+
+    def evict(self, max_age_days=MAX_AGE_DAYS, max_entries=MAX_ENTRIES):
+        """Remove entries unused for max_age_days and the least recently
+        used entries beyond max_entries. Return number of entries removed.
+        """
+        removed = 0
+        with self.lock:
+            if max_age_days is not None:
+                cutoff = time.time() - max_age_days * 86400
+                removed += self.conn.execute(
+                    "DELETE FROM files WHERE last_used < ?", (cutoff,)
+                ).rowcount
+            if max_entries is not None:
+                removed += self.conn.execute(
+                    "DELETE FROM files WHERE path IN (SELECT path FROM files "
+                    "ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (max_entries,),
+                ).rowcount
+            self.conn.commit()
+        return removed
+
+    def close(self):
+        """Commit and close the cache."""
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
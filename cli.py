@@ -0,0 +1,198 @@
+"""
+CCA Folder Processor - command line interface
+
+Creates SIPs and a description CSV without a GUI, e.g. on a headless ingest
+server. Progress is written to stdout as one JSON object per line; other
+output is sent to stderr. Ctrl-C cancels processing cleanly.
+
+(c) Canadian Centre for Architecture
+MIT License
+"""
+import argparse
+import glob
+import json
+import os
+import signal
+import sys
+
+from cache import MAX_AGE_DAYS, MAX_ENTRIES
+from processor import PIPELINE_DEPTH, SIPProcessor
+
+
+def _make_parser():
+    parser = argparse.ArgumentParser(
+        description="Create Archivematica-ready SIPs from source folders."
+    )
+    parser.add_argument(
+        "-m",
+        "--manifest",
+        help="Text file listing source folders, one per line",
+        action="append",
+        default=[],
+    )
+    parser.add_argument("-b", "--bag", help="Create SIPs as bags", action="store_true")
+    parser.add_argument(
+        "-p",
+        "--pii",
+        help="Scan SIPs for PII with bulk_extractor",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--verify",
+        help="Check copied files against the source and write fixity reports",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--pii-threads",
+        help="Number of threads for each bulk_extractor PII scan",
+        type=int,
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Number of SIPs in each stage at once (default: 1)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--pipeline-depth",
+        help="SIPs in progress per worker, each in a different stage "
+        "(default: %(default)s)",
+        type=int,
+        default=PIPELINE_DEPTH,
+    )
+    parser.add_argument(
+        "--max-pending",
+        help="Maximum GB of SIPs in progress at once "
+        "(default: half the free space at the destination)",
+        type=float,
+    )
+    parser.add_argument(
+        "--device-readers",
+        help="SIPs copied from each source device at once; 0 for no limit "
+        "(default: 1 for spinning disks, no limit for SSDs and network shares)",
+        type=int,
+    )
+    parser.add_argument(
+        "--cache",
+        help="SQLite file caching digests and identifications between runs",
+    )
+    parser.add_argument(
+        "--cache-max-age",
+        help="Evict cache entries unused for this many days (default: %(default)s)",
+        type=int,
+        default=MAX_AGE_DAYS,
+    )
+    parser.add_argument(
+        "--cache-max-entries",
+        help="Maximum number of cache entries kept (default: %(default)s)",
+        type=int,
+        default=MAX_ENTRIES,
+    )
+    parser.add_argument(
+        "sources",
+        help="Source folders (glob patterns are expanded)",
+        nargs="*",
+    )
+    parser.add_argument(
+        "destination",
+        help="Destination; SIPs are written to its SIPs subdirectory",
+    )
+    return parser
+
+
+def read_manifest(path):
+    """Return source paths listed in manifest file, skipping comments."""
+    sources = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                sources.append(line)
+    return sources
+
+
+def expand_sources(patterns):
+    """Expand glob patterns and return list of unique directories."""
+    sources = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for match in matches:
+            path = os.path.abspath(match)
+            if not os.path.isdir(path):
+                print("Skipping {}: not a directory".format(match), file=sys.stderr)
+                continue
+            if path not in sources:
+                sources.append(path)
+    return sources
+
+
+def main(argv=None):
+    args = _make_parser().parse_intermixed_args(argv)
+
+    patterns = list(args.sources)
+    for manifest in args.manifest:
+        patterns.extend(read_manifest(manifest))
+    sources = expand_sources(patterns)
+    if not sources:
+        print("No source folders to process", file=sys.stderr)
+        return 1
+
+    max_pending_bytes = None
+    if args.max_pending is not None:
+        max_pending_bytes = int(args.max_pending * 1000000000)
+
+    destination = os.path.abspath(args.destination)
+    sips = os.path.join(destination, "SIPs")
+    os.makedirs(sips, exist_ok=True)
+
+    # Keep stdout for JSON events and send everything else, including the
+    # output of child processes, to stderr while processing.
+    sys.stdout.flush()
+    stdout_fd = sys.stdout.fileno()
+    saved_stdout_fd = os.dup(stdout_fd)
+    events = os.fdopen(os.dup(stdout_fd), "w", buffering=1)
+    os.dup2(sys.stderr.fileno(), stdout_fd)
+
+    def report(event):
+        events.write(json.dumps(event) + "\n")
+
+    try:
+        processor = SIPProcessor(
+            sources,
+            sips,
+            args.bag,
+            args.pii,
+            destination,
+            workers=args.workers,
+            report=report,
+            cache_path=args.cache,
+            cache_max_age_days=args.cache_max_age,
+            cache_max_entries=args.cache_max_entries,
+            pii_threads=args.pii_threads,
+            pipeline_depth=args.pipeline_depth,
+            max_pending_bytes=max_pending_bytes,
+            device_readers=args.device_readers,
+            verify=args.verify,
+        )
+        # Cancel cleanly on Ctrl-C or kill, stopping tools and moving
+        # incomplete SIPs aside.
+        handlers = {
+            signum: signal.signal(signum, lambda *args: processor.cancel())
+            for signum in (signal.SIGINT, signal.SIGTERM)
+        }
+        try:
+            failed = processor.run()
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved_stdout_fd, stdout_fd)
+        os.close(saved_stdout_fd)
+        events.close()
+    return 1 if failed or processor.cancelled.is_set() else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
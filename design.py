@@ -34,12 +34,20 @@ class Ui_MainWindow(object):
         self.bagSIPs = QtWidgets.QCheckBox(self.centralwidget)
         self.bagSIPs.setObjectName("bagSIPs")
         self.gridLayout.addWidget(self.bagSIPs, 10, 0, 1, 1)
+        self.workers = QtWidgets.QSpinBox(self.centralwidget)
+        self.workers.setMinimum(1)
+        self.workers.setMaximum(32)
+        self.workers.setObjectName("workers")
+        self.gridLayout.addWidget(self.workers, 10, 1, 1, 1)
         self.cancelBtn = QtWidgets.QPushButton(self.centralwidget)
         self.cancelBtn.setObjectName("cancelBtn")
         self.gridLayout.addWidget(self.cancelBtn, 17, 1, 1, 1)
         self.bulkExt = QtWidgets.QCheckBox(self.centralwidget)
         self.bulkExt.setObjectName("bulkExt")
         self.gridLayout.addWidget(self.bulkExt, 11, 0, 1, 1)
+        self.verifyFixity = QtWidgets.QCheckBox(self.centralwidget)
+        self.verifyFixity.setObjectName("verifyFixity")
+        self.gridLayout.addWidget(self.verifyFixity, 11, 1, 1, 1)
         self.label_3 = QtWidgets.QLabel(self.centralwidget)
         self.label_3.setObjectName("label_3")
         self.gridLayout.addWidget(self.label_3, 7, 0, 1, 1)
@@ -85,8 +93,10 @@ class Ui_MainWindow(object):
         MainWindow.setWindowTitle(_translate("MainWindow", "Folder Processor", None))
         self.label.setText(_translate("MainWindow", "<html><head/><body><p><span style=\" font-weight:600;\">Options</span></p></body></html>", None))
         self.bagSIPs.setText(_translate("MainWindow", "Bag SIPs", None))
+        self.workers.setPrefix(_translate("MainWindow", "Parallel SIPs: ", None))
         self.cancelBtn.setText(_translate("MainWindow", "Cancel", None))
         self.bulkExt.setText(_translate("MainWindow", "Run bulk_extractor", None))
+        self.verifyFixity.setText(_translate("MainWindow", "Verify fixity", None))
         self.label_3.setText(_translate("MainWindow", "<html><head/><body><p><span style=\" font-weight:600;\">Destination</span></p></body></html>", None))
         self.label_5.setText(_translate("MainWindow", "<html><head/><body><p><span style=\" font-weight:600;\">Source</span></p></body></html>", None))
         self.destination.setPlaceholderText(_translate("MainWindow", "/path/to/destination", None))
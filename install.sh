@@ -17,6 +17,10 @@ fi
 sudo mkdir $folderprocessor_dir
 
 sudo cp main.py $folderprocessor_dir
+sudo cp processor.py $folderprocessor_dir
+sudo cp cache.py $folderprocessor_dir
+sudo cp siegfried.py $folderprocessor_dir
+sudo cp cli.py $folderprocessor_dir
 sudo cp launch $folderprocessor_dir
 sudo cp design.py $folderprocessor_dir
 sudo cp design.ui $folderprocessor_dir
@@ -25,7 +29,6 @@ sudo cp LICENSE $folderprocessor_dir
 sudo cp README.md $folderprocessor_dir
 sudo cp deps/dfxml/python/dfxml.py $folderprocessor_dir
 sudo cp deps/dfxml/python/Objects.py $folderprocessor_dir
-sudo cp deps/dfxml/python/walk_to_dfxml.py $folderprocessor_dir
 
 # Create launch.desktop file
 launch_file="/usr/share/applications/FolderProcessor.desktop"
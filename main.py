@@ -6,313 +6,179 @@ Developed by Tessa Walsh
 2017-2023
 MIT License
 """
-import csv
 import datetime
-import itertools
-import math
 import os
-import shutil
-import subprocess
 import sys
-from time import localtime, strftime
+import weakref
 
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 
 import design
-import Objects
-
-
-CSV_HEADERS = [
-    "Parent ID",
-    "Identifier",
-    "Title",
-    "Archive Creator",
-    "Date expression",
-    "Date start",
-    "Date end",
-    "Level of description",
-    "Extent and medium",
-    "Scope and content",
-    "Arrangement (optional)",
-    "Accession number",
-    "Appraisal, destruction, and scheduling information (optional)",
-    "Name access points (optional)",
-    "Geographic access points (optional)",
-    "Conditions governing access (optional)",
-    "Conditions governing reproduction (optional)",
-    "Language of material (optional)",
-    "Physical characteristics & technical requirements affecting use (optional)",
-    "Finding aids (optional)",
-    "Related units of description (optional)",
-    "Archival history (optional)",
-    "Immediate source of acquisition or transfer (optional)",
-    "Archivists' note (optional)",
-    "General note (optional)",
-    "Description status",
-]
-
-
-def convert_size(size):
-    """Convert size in bytes to human-readable string."""
-    if size == 0:
-        return "0 bytes"
-    size_name = ("bytes", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
-    i = int(math.floor(math.log(size, 1024)))
-    p = math.pow(1024, i)
-    s = round(size / p)
-    s = str(s)
-    s = s.replace(".0", "")
-    return "{} {}".format(s, size_name[i])
-
-
-class CheckableDirModel(QDirModel):
-    """Class to put checkbox on the folders."""
-    dataChanged = pyqtSignal(QModelIndex, QModelIndex)
+from processor import VERSION, SIPProcessor, convert_size, format_summary
+
+# Resolution of the progress bar, which tracks bytes copied.
+PROGRESS_STEPS = 1000
+
+
+class CheckableDirModel(QFileSystemModel):
+    """File system model with checkboxes on the folders.
+
+    Folders are loaded lazily in a background thread by QFileSystemModel.
+    Check states are stored by path. A folder without a state of its own
+    inherits the state of its nearest ancestor that has one, so checking a
+    folder checks all of its descendants without visiting them. Each
+    checked folder becomes one SIP holding all of its descendants, so the
+    descendants of a checked folder cannot be checked or unchecked.
+    """
 
     def __init__(self, parent=None):
-        QDirModel.__init__(self, None)
+        QFileSystemModel.__init__(self, parent)
         self.checks = {}
 
     def data(self, index, role=Qt.DisplayRole):
         if role != Qt.CheckStateRole:
-            return QDirModel.data(self, index, role)
+            return QFileSystemModel.data(self, index, role)
         else:
             if index.column() == 0:
                 return self.checkState(index)
 
     def flags(self, index):
-        return QDirModel.flags(self, index) | Qt.ItemIsUserCheckable
+        flags = QFileSystemModel.flags(self, index)
+        if not self.parentChecked(self.filePath(index)):
+            flags |= Qt.ItemIsUserCheckable
+        return flags
+
+    def pathCheckState(self, path):
+        """Return check state of path, inherited from its ancestors."""
+        while True:
+            if path in self.checks:
+                return self.checks[path]
+            parent = os.path.dirname(path)
+            if parent == path:
+                return Qt.Unchecked
+            path = parent
+
+    def parentChecked(self, path):
+        """Return True if path is inside a checked folder."""
+        parent = os.path.dirname(path)
+        return parent != path and self.pathCheckState(parent) == Qt.Checked
 
     def checkState(self, index):
-        if index in self.checks:
-            return self.checks[index]
-        else:
-            return Qt.Unchecked
+        return self.pathCheckState(self.filePath(index))
 
     def setData(self, index, value, role):
         if role == Qt.CheckStateRole and index.column() == 0:
-            self.checks[index] = value
-            self.dataChanged.emit(index, index)
+            path = self.filePath(index)
+            if self.parentChecked(path):
+                return False
+            # Descendants inherit the new state.
+            prefix = os.path.join(path, "")
+            for checked_path in [p for p in self.checks if p.startswith(prefix)]:
+                del self.checks[checked_path]
+            self.checks[path] = value
+            self.dataChanged.emit(index, index, [Qt.CheckStateRole])
+            self.emitLoadedChildrenChanged(index)
             return True
 
-        return QDirModel.setData(self, index, value, role)
+        return QFileSystemModel.setData(self, index, value, role)
+
+    def emitLoadedChildrenChanged(self, parent):
+        """Signal check state change for descendants already loaded."""
+        rows = self.rowCount(parent)
+        if not rows:
+            return
+        self.dataChanged.emit(
+            self.index(0, 0, parent),
+            self.index(rows - 1, 0, parent),
+            [Qt.CheckStateRole],
+        )
+        for row in range(rows):
+            self.emitLoadedChildrenChanged(self.index(row, 0, parent))
+
+    def checkedPaths(self):
+        """Return sorted list of checked folders not inside another one."""
+        paths = []
+        for path, value in self.checks.items():
+            if value != Qt.Checked or not os.path.isdir(path):
+                continue
+            parent = os.path.dirname(path)
+            if parent != path and self.pathCheckState(parent) == Qt.Checked:
+                continue
+            paths.append(path)
+        return sorted(paths)
 
 
 class SIPThread(QThread):
-    """QThread used to create SIPs and write descriptive CSV."""
+    """QThread used to run SIPProcessor from the GUI."""
     increment_progress_bar = pyqtSignal("QString")
+    update_progress = pyqtSignal(dict)
+    update_stage = pyqtSignal(dict)
+    show_warning = pyqtSignal("QString")
 
     def __init__(
-        self, dirs_to_process, destination, bag_files, scan_for_pii, output_dir
+        self,
+        dirs_to_process,
+        destination,
+        bag_files,
+        scan_for_pii,
+        output_dir,
+        workers=1,
+        stage_limits=None,
+        verify=False,
     ):
         QThread.__init__(self)
-        self.dirs_to_process = dirs_to_process
-        self.destination = destination
-        self.bag_files = bag_files
-        self.scan_for_pii = scan_for_pii
-        self.output_dir = output_dir
+        self.summary = ""
+        # Last error message of each SIP that failed, warnings in the order
+        # they were reported, and the batch totals.
+        self.errors = {}
+        self.warnings = []
+        self.total = 0
+        self.failed = 0
+        # Report through a weak reference to avoid a reference cycle, which
+        # would leave the thread to the garbage collector.
+        report = weakref.WeakMethod(self.report)
+        self.processor = SIPProcessor(
+            dirs_to_process,
+            destination,
+            bag_files,
+            scan_for_pii,
+            output_dir,
+            workers=workers,
+            stage_limits=stage_limits,
+            report=lambda event: report()(event),
+            verify=verify,
+        )
 
     def __del__(self):
         self.wait()
 
-    def create_sip(self, source, destination, bag_files, scan_for_pii):
-        """Create SIP from source directory."""
-        basename = os.path.basename(os.path.abspath(source))
-        sip_dir = os.path.join(destination, basename)
-        object_dir = os.path.join(sip_dir, "objects")
-        original_dir = os.path.join(object_dir, basename)
-        metadata_dir = os.path.join(sip_dir, "metadata")
-        subdoc_dir = os.path.join(metadata_dir, "submissionDocumentation")
-
-        for newfolder in sip_dir, object_dir, metadata_dir, subdoc_dir:
-            os.makedirs(newfolder)
-
-        try:
-            shutil.copytree(source, original_dir, symlinks=False, ignore=None)
-        except shutil.Error as err:
-            print(
-                "Error copying files from {} to {}: {}".format(
-                    source, original_dir, err
-                )
-            )
-            return 1
-
-        # Run Brunnhilde and write results to submissionDocumentation.
-        objects_abspath = os.path.abspath(object_dir)
-        brunnhilde_cmd = "brunnhilde.py -zw '{}' '{}' brunnhilde".format(
-            objects_abspath, subdoc_dir
-        )
-        if scan_for_pii:
-            brunnhilde_cmd = "brunnhilde.py -zbw '{}' '{}' brunnhilde".format(
-                objects_abspath, subdoc_dir
-            )
-        subprocess.call(brunnhilde_cmd, shell=True)
-
-        # Write DFXML to submissionDocumentation
-        dfxml_path = os.path.join(subdoc_dir, "dfxml.xml")
-        dfxml_cmd = "cd '{}' && python3 /usr/share/ccatools/folderprocessor/walk_to_dfxml.py > '{}'".format(
-            object_dir, dfxml_path
-        )
-        subprocess.call(dfxml_cmd, shell=True)
-
-        # Bag files or write checksum manifest.
-        if bag_files:
-            # TODO: Multithread bagging via --processes when bug described at
-            # https://github.com/LibraryOfCongress/bagit-python/issues/130 is
-            # resolved.
-            subprocess.call("cd ~ && bagit.py '{}'".format(sip_dir), shell=True)
-        else:
-            md5deep_cmd = "cd '{}' && md5deep -rl ../objects > checksum.md5".format(
-                metadata_dir
-            )
-            subprocess.call(md5deep_cmd, shell=True)
-
-        # Set file permissions.
-        subprocess.call(
-            "find '%s' -type d -exec chmod 755 {} \;" % (sip_dir), shell=True
-        )
-        subprocess.call(
-            "find '%s' -type f -exec chmod 644 {} \;" % (sip_dir), shell=True
-        )
-
-    def write_description_csv(self, output_dir, sips, bag_files):
-        """Write description CSV."""
-        csv_path = os.path.join(output_dir, "description.csv")
-        with open(csv_path, "w") as csv_file:
-            writer = csv.writer(csv_file, quoting=csv.QUOTE_NONNUMERIC)
-            writer.writerow(CSV_HEADERS)
-            for item in os.listdir(sips):
-                sip_path = os.path.abspath(os.path.join(sips, item))
-                if not os.path.isdir(sip_path):
-                    continue
-                self.write_csv_row(writer, sip_path, bag_files)
-
-    @staticmethod
-    def write_csv_row(writer, sip_path, bag_files):
-        """Write CSV row for SIP directory."""
-        file_count = 0
-        total_bytes = 0
-        mtimes = []
-
-        # Parse FileObjects in DFXML file.
-        dfxml_file = os.path.abspath(
-            os.path.join(sip_path, "metadata", "submissionDocumentation", "dfxml.xml")
-        )
-        if bag_files:
-            dfxml_file = os.path.abspath(
-                os.path.join(
-                    sip_path, "data", "metadata", "submissionDocumentation", "dfxml.xml"
-                )
-            )
-        for (event, obj) in Objects.iterparse(dfxml_file):
-            if not isinstance(obj, Objects.FileObject):
-                continue
-            
-            # skip directories and links
-            if obj.name_type and obj.name_type != "r":
-                continue
-
-            file_count += 1
-            mtime = ""
-            if obj.mtime:
-                mtime = str(obj.mtime)
-            mtimes.append(mtime)
-            total_bytes += obj.filesize
-
-        # Build extent statement.
-        size_readable = convert_size(total_bytes)
-        extent = "EMPTY"
-        if file_count == 1:
-            extent = "1 digital file ({})".format(size_readable)
-        if file_count > 1:
-            extent = "{} digital files ({})".format(file_count, size_readable)
-
-        # Build date statement from modified dates.
-        date_earliest = "N/A"
-        date_latest = "N/A"
-        if mtimes:
-            date_earliest = min(mtimes)[:10]
-            date_latest = max(mtimes)[:10]
-        date_statement = "{}-{}".format(date_earliest[:4], date_latest[:4])
-        if date_earliest[:4] == date_latest[:4]:
-            date_statement = date_earliest[:4]
-
-        # Write scope and content note from information in brunnhilde reports.
-        scope_content = ""
-        if extent != "EMPTY":
-            file_formats = []
-            fileformat_csv = os.path.join(
-                sip_path,
-                "metadata",
-                "submissionDocumentation",
-                "brunnhilde",
-                "csv_reports",
-                "formats.csv",
-            )
-            if bag_files:
-                fileformat_csv = os.path.join(
-                    sip_path,
-                    "data",
-                    "metadata",
-                    "submissionDocumentation",
-                    "brunnhilde",
-                    "csv_reports",
-                    "formats.csv",
-                )
-            with open(fileformat_csv, "r") as f:
-                reader = csv.reader(f)
-                next(reader)
-                for row in itertools.islice(reader, 5):
-                    file_formats.append(row[0])
-            file_formats = [format_ or "Unidentified" for format_ in file_formats]
-            formats_list = ", ".join(file_formats)
-            scope_content = 'Original directory name: "{}". Most common file formats: {}'.format(
-                os.path.basename(sip_path), formats_list
-            )
-
-        writer.writerow(
-            [
-                "",
-                os.path.basename(sip_path),
-                "",
-                "",
-                date_statement,
-                date_earliest,
-                date_latest,
-                "File",
-                extent,
-                scope_content,
-                "",
-                "",
-                "",
-                "",
-                "",
-                "",
-                "",
-                "",
-                "",
-                "",
-                "",
-                "",
-                "",
-                "",
-                "",
-                "",
-            ]
-        )
+    def cancel(self):
+        """Cancel processing; run returns once running SIPs have stopped."""
+        self.processor.cancel()
+
+    def report(self, event):
+        """Translate SIPProcessor events into signals."""
+        if event["event"] == "sip_done":
+            self.increment_progress_bar.emit(event["source"])
+        elif event["event"] == "progress":
+            self.update_progress.emit(event)
+        elif event["event"] == "stage":
+            self.update_stage.emit(event)
+        elif event["event"] == "warning":
+            self.warnings.append(event["message"])
+            self.show_warning.emit(event["message"])
+        elif event["event"] == "error":
+            self.errors[event["sip"]] = event["message"]
+        elif event["event"] == "done":
+            self.summary = format_summary(event["stages"])
+            self.total = event["total"]
+            self.failed = event["failed"]
 
     def run(self):
         """Process directories."""
-        for dir_to_process in self.dirs_to_process:
-            self.create_sip(
-                dir_to_process, self.destination, self.bag_files, self.scan_for_pii
-            )
-            self.increment_progress_bar.emit(dir_to_process)
-            self.write_description_csv(
-                self.output_dir, self.destination, self.bag_files
-            )
+        self.processor.run()
 
 
 class ProcessorApp(QMainWindow, design.Ui_MainWindow):
@@ -326,18 +192,24 @@ class ProcessorApp(QMainWindow, design.Ui_MainWindow):
         self.sourceBtn.clicked.connect(self.browse_source)
         self.destinationBtn.clicked.connect(self.browse_dest)
         self.processBtn.clicked.connect(self.start_processing)
+        self.cancelBtn.clicked.connect(self.cancel_processing)
+        self.cancelBtn.setEnabled(False)
 
         # Connect About dialog.
         self.actionAbout.triggered.connect(self.about_dialog)
 
         self.progressBar.setValue(0)
+        self.sips_done = 0
+        self.sips_total = 0
+        self.progress_text = ""
+        self.running = {}
 
     def about_dialog(self):
         """Set About dialog."""
         QMessageBox.information(
             self,
             "About",
-            "Folder Processor v1.1.2\nCanadian Centre for Architecture\nDeveloper: Tessa Walsh\n2018-2023\nMIT License\nhttps://github.com/CCA-Public/folderprocessor",
+            "Folder Processor v" + VERSION + "\nCanadian Centre for Architecture\nDeveloper: Tessa Walsh\n2018-2023\nMIT License\nhttps://github.com/CCA-Public/folderprocessor",
         )
 
     def browse_source(self):
@@ -345,6 +217,7 @@ class ProcessorApp(QMainWindow, design.Ui_MainWindow):
         source = QFileDialog.getExistingDirectory(self, "Select folder")
         if source:
             self.model = CheckableDirModel()
+            self.model.setRootPath(source)
             self.treeView.setModel(self.model)
             self.treeView.setSortingEnabled(True)
             self.treeView.setRootIndex(self.model.index(source))
@@ -357,16 +230,106 @@ class ProcessorApp(QMainWindow, design.Ui_MainWindow):
             self.destination.setText(directory)
 
     def increment_progress_bar(self, dir_to_process):
-        """Increment progress bar."""
-        self.progressBar.setValue(self.progressBar.value() + 1)
+        """Count finished SIP."""
+        self.sips_done += 1
+        self.show_status()
+
+    def update_progress(self, event):
+        """Show bytes and files copied, throughput and copy ETA."""
+        if event["bytes_total"]:
+            fraction = event["bytes_done"] / event["bytes_total"]
+        elif event["files_total"]:
+            fraction = event["files_done"] / event["files_total"]
+        else:
+            fraction = 1
+        self.progressBar.setValue(int(min(fraction, 1) * PROGRESS_STEPS))
+        text = "Copied {} of {} files ({} of {})".format(
+            event["files_done"],
+            event["files_total"],
+            convert_size(event["bytes_done"]),
+            convert_size(event["bytes_total"]),
+        )
+        if event["mb_per_s"]:
+            text += " at {} MB/s".format(event["mb_per_s"])
+        if event["eta_seconds"]:
+            text += ", about {} left to copy".format(
+                datetime.timedelta(seconds=event["eta_seconds"])
+            )
+        self.progress_text = text + "."
+        self.show_status()
+
+    def update_stage(self, event):
+        """Track the step each SIP is in."""
+        if event["state"] == "started":
+            self.running[event["sip"]] = event["stage"]
+        elif self.running.get(event["sip"]) == event["stage"]:
+            del self.running[event["sip"]]
+        self.show_status()
+
+    def show_status(self):
+        """Show SIPs done, copy progress, running steps, failures and warnings."""
+        parts = ["{} of {} SIPs done.".format(self.sips_done, self.sips_total)]
+        if self.progress_text:
+            parts.append(self.progress_text)
+        if self.running:
+            parts.append(
+                "Running: {}.".format(
+                    ", ".join(
+                        "{} ({})".format(stage, sip)
+                        for sip, stage in sorted(self.running.items())
+                    )
+                )
+            )
+        if self.get_thread.errors:
+            parts.append("{} SIP(s) failed.".format(len(self.get_thread.errors)))
+        if self.get_thread.warnings:
+            parts.append("{} warning(s).".format(len(self.get_thread.warnings)))
+        self.status.setText(" ".join(parts))
+
+    def show_warning(self, message):
+        """Count warning from SIP processing; all are listed by done."""
+        self.show_status()
+
+    def cancel_processing(self):
+        """Cancel processing without leaving tools or partial SIPs behind."""
+        self.cancelBtn.setEnabled(False)
+        thread = getattr(self, "get_thread", None)
+        if thread is None:
+            return
+        thread.cancel()
+        self.status.setText(
+            "Cancelling. Incomplete SIPs will be moved to the incomplete folder."
+        )
 
     def done(self):
         """Handle process completion."""
         self.cancelBtn.setEnabled(False)
         self.processBtn.setEnabled(True)
-        self.progressBar.setValue(self.progressBar.value() + 1)
-        QMessageBox.information(self, "Done!", "Process complete.")
-        self.status.setText("Completed")
+        self.progressBar.setValue(PROGRESS_STEPS)
+        thread = self.get_thread
+        message = "Process complete."
+        status = "Completed"
+        if thread.processor.cancelled.is_set():
+            message = "Process cancelled."
+        elif thread.failed:
+            message = "Process complete, but {} of {} SIP(s) failed:\n".format(
+                thread.failed, thread.total
+            )
+            message += "\n".join(
+                "{}: {}".format(sip, error.strip().splitlines()[-1] if error else "")
+                for sip, error in sorted(thread.errors.items())
+            )
+            status = "Completed with {} failed SIP(s)".format(thread.failed)
+        if thread.warnings:
+            message += "\n\nWarnings:\n" + "\n".join(thread.warnings)
+        if thread.summary:
+            message += "\n\nTime per stage:\n" + thread.summary
+        if thread.failed or thread.warnings:
+            QMessageBox.warning(self, "Done", message)
+        else:
+            QMessageBox.information(self, "Done!", message)
+        self.status.setText(status)
+        self.running = {}
         self.progressBar.setValue(0)
 
     def start_processing(self):
@@ -374,14 +337,15 @@ class ProcessorApp(QMainWindow, design.Ui_MainWindow):
         self.status.setText("Processing. Please be patient.")
 
         # Create list of paths for checked folders.
-        dirs_to_process = []
-        for index, value in self.model.checks.items():
-            if value != 0:
-                if os.path.isdir(self.model.filePath(index)):
-                    dirs_to_process.append(self.model.filePath(index))
-
-        # Prepare progress bar.
-        self.progressBar.setMaximum(len(dirs_to_process) + 1)
+        dirs_to_process = self.model.checkedPaths()
+
+        # Prepare progress bar, which shows copy progress.
+        self.sips_done = 0
+        self.sips_total = len(dirs_to_process)
+        self.progress_text = ""
+        self.running = {}
+        self.progressBar.setMaximum(PROGRESS_STEPS)
+        self.progressBar.setFormat("Copied %p%")
         self.progressBar.setValue(0)
 
         # Create output directories.
@@ -389,7 +353,7 @@ class ProcessorApp(QMainWindow, design.Ui_MainWindow):
         if not os.path.exists(destination):
             os.makedirs(destination)
         sips = os.path.join(destination, "SIPs")
-        os.makedirs(sips)
+        os.makedirs(sips, exist_ok=True)
 
         # Parse checkboxes.
         bag_files = False
@@ -401,15 +365,23 @@ class ProcessorApp(QMainWindow, design.Ui_MainWindow):
 
         # Create SIP for each source directory and write descriptive CSV.
         self.get_thread = SIPThread(
-            dirs_to_process, sips, bag_files, scan_for_pii, destination
+            dirs_to_process,
+            sips,
+            bag_files,
+            scan_for_pii,
+            destination,
+            workers=self.workers.value(),
+            verify=self.verifyFixity.isChecked(),
         )
         self.get_thread.increment_progress_bar["QString"].connect(
             self.increment_progress_bar
         )
+        self.get_thread.update_progress.connect(self.update_progress)
+        self.get_thread.update_stage.connect(self.update_stage)
+        self.get_thread.show_warning["QString"].connect(self.show_warning)
         self.get_thread.finished.connect(self.done)
         self.get_thread.start()
         self.cancelBtn.setEnabled(True)
-        self.cancelBtn.clicked.connect(self.get_thread.terminate)
         self.processBtn.setEnabled(False)
 
 
@@ -0,0 +1,2467 @@
+"""
+CCA Folder Processor - SIP creation and description
+
+Creates SIPs and writes the description CSV without any GUI dependencies,
+for use by both the PyQt application (main.py) and the command line (cli.py).
+
+(c) Canadian Centre for Architecture
+MIT License
+"""
+import concurrent.futures
+import contextlib
+import csv
+import datetime
+import errno
+import fcntl
+import hashlib
+import io
+import itertools
+import json
+import math
+import os
+import shutil
+import signal
+import stat
+import subprocess
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+import bagit
+
+import Objects
+from cache import MAX_AGE_DAYS, MAX_ENTRIES, DigestCache
+from siegfried import SiegfriedServer
+
+
+CSV_HEADERS = [
+    "Parent ID",
+    "Identifier",
+    "Title",
+    "Archive Creator",
+    "Date expression",
+    "Date start",
+    "Date end",
+    "Level of description",
+    "Extent and medium",
+    "Scope and content",
+    "Arrangement (optional)",
+    "Accession number",
+    "Appraisal, destruction, and scheduling information (optional)",
+    "Name access points (optional)",
+    "Geographic access points (optional)",
+    "Conditions governing access (optional)",
+    "Conditions governing reproduction (optional)",
+    "Language of material (optional)",
+    "Physical characteristics & technical requirements affecting use (optional)",
+    "Finding aids (optional)",
+    "Related units of description (optional)",
+    "Archival history (optional)",
+    "Immediate source of acquisition or transfer (optional)",
+    "Archivists' note (optional)",
+    "General note (optional)",
+    "Description status",
+]
+
+# Maximum number of SIPs that may be in each create_sip stage at once. None
+# means limited only by the worker count.
+STAGE_LIMITS = {
+    "copy": 2,
+    "characterize": None,
+    "pii": 1,
+    "dfxml": None,
+    "checksum": None,
+    "permissions": None,
+    "verify": None,
+}
+
+# Maximum number of SIPs copied from one spinning disk (e.g. a USB disk) at
+# once. Solid state devices and network shares are only limited by the copy
+# stage limit.
+DEVICE_READERS = 1
+
+# copy_tree copies each directory's files in shards of up to this many bytes
+# or files, so that one large folder can be copied by several threads.
+SHARD_BYTES = 1024 * 1024 * 1024
+SHARD_FILES = 1000
+
+# Read size used when copying and hashing files.
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+
+# Digests computed for every object file while it is copied. SHA-512 is
+# added when bagging so that bag manifests can be written without rereading.
+HASH_ALGORITHMS = ("md5", "sha256")
+BAG_ALGORITHMS = ("sha256", "sha512")
+
+# Linux ioctl that makes a file share another file's data blocks (reflink).
+FICLONE = 0x40049409
+
+# Largest request passed to copy_file_range or sendfile at once.
+KERNEL_COPY_CHUNK = 1024 * 1024 * 1024
+
+# Errors meaning a zero-copy method cannot be used for a pair of files.
+ZERO_COPY_UNSUPPORTED = frozenset(
+    (
+        errno.EBADF,
+        errno.EINVAL,
+        errno.ENOSYS,
+        errno.ENOTTY,
+        errno.EOPNOTSUPP,
+        errno.EXDEV,
+    )
+)
+
+# Fileobject properties that read_fileobjects can read from DFXML.
+FILEOBJECT_FIELDS = (
+    "filename",
+    "name_type",
+    "filesize",
+    "mtime",
+    "atime",
+    "ctime",
+    "md5",
+    "sha1",
+    "sha256",
+    "sha512",
+)
+
+# Seconds an external tool may run for one SIP before it is stopped, and
+# the shared Siegfried server ("sf") may take to identify one SIP. None
+# means no limit.
+TOOL_TIMEOUTS = {
+    "brunnhilde.py": 24 * 3600,
+    "bulk_extractor": 48 * 3600,
+    "sf": 24 * 3600,
+}
+
+# Bytes of each output stream of an external tool kept for error messages.
+OUTPUT_TAIL = 64 * 1024
+
+# Seconds a stopped tool is given to exit after SIGTERM, before SIGKILL.
+KILL_GRACE = 10
+
+# Permissions applied to everything in a SIP.
+DIR_MODE = 0o755
+FILE_MODE = 0o644
+
+VERSION = "1.1.2"
+
+# Number of SIPs per worker that may be in progress at once, each in a
+# different stage.
+PIPELINE_DEPTH = 3
+
+# Job journal written to the output directory, next to description.csv.
+JOURNAL_FILENAME = "journal.json"
+
+# Per-stage metrics log written to the output directory.
+METRICS_FILENAME = "metrics.jsonl"
+SUMMARY_FILENAME = "summary.jsonl"
+
+# Folder in the output directory holding the verify stage's fixity reports.
+FIXITY_DIRNAME = "fixity"
+FIXITY_HEADERS = ["Path", "Problem", "Expected", "Actual"]
+FIXITY_FIELDS = ("path", "problem", "expected", "actual")
+
+# Folder next to the destination to which SIPs left incomplete by
+# cancellation are moved.
+INCOMPLETE_DIRNAME = "incomplete"
+
+
+def convert_size(size):
+    """Convert size in bytes to human-readable string."""
+    if size == 0:
+        return "0 bytes"
+    size_name = ("bytes", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
+    i = int(math.floor(math.log(size, 1024)))
+    p = math.pow(1024, i)
+    s = round(size / p)
+    s = str(s)
+    s = s.replace(".0", "")
+    return "{} {}".format(s, size_name[i])
+
+
+def iso8601(timestamp):
+    """Convert POSIX timestamp to ISO 8601 UTC string."""
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime(
+        "%Y-%m-%dT%H:%M:%SZ"
+    )
+
+
+class FileRecord(object):
+    """Metadata and digests for one file or directory in a SIP's objects."""
+
+    __slots__ = (
+        "path",
+        "name_type",
+        "size",
+        "mode",
+        "inode",
+        "nlink",
+        "uid",
+        "gid",
+        "mtime",
+        "atime",
+        "ctime",
+        "md5",
+        "sha256",
+        "sha512",
+    )
+
+    def __init__(self, path, name_type, stat_result, digests=None):
+        self.path = path
+        self.name_type = name_type
+        self.size = stat_result.st_size
+        self.mode = stat_result.st_mode
+        self.inode = stat_result.st_ino
+        self.nlink = stat_result.st_nlink
+        self.uid = stat_result.st_uid
+        self.gid = stat_result.st_gid
+        self.mtime = iso8601(stat_result.st_mtime)
+        self.atime = iso8601(stat_result.st_atime)
+        self.ctime = iso8601(stat_result.st_ctime)
+        digests = digests or {}
+        self.md5 = digests.get("md5")
+        self.sha256 = digests.get("sha256")
+        self.sha512 = digests.get("sha512")
+
+
+def _hash_stream(src, algorithms, buffer_size, dst=None):
+    """Read file object to the end, hashing it and writing it to dst if given."""
+    hashers = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    while True:
+        size = src.readinto(buf)
+        if not size:
+            break
+        chunk = view[:size]
+        for hasher in hashers.values():
+            hasher.update(chunk)
+        if dst is not None:
+            dst.write(chunk)
+    return {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items()}
+
+
+def _check_regular(path):
+    # open() on a named pipe or device would block or never reach the end.
+    mode = os.stat(path).st_mode
+    if not stat.S_ISREG(mode):
+        kind = "a named pipe" if stat.S_ISFIFO(mode) else "not a regular file"
+        raise shutil.SpecialFileError("`{}` is {}".format(path, kind))
+
+
+def _reflink(src, dst):
+    """Make dst share src's data blocks. Return False if not supported."""
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError as err:
+        if err.errno in ZERO_COPY_UNSUPPORTED:
+            return False
+        raise
+    return True
+
+
+def _kernel_copy(src, dst):
+    """Copy src to dst without passing the data through Python.
+
+    copy_file_range is tried first, then sendfile. Return False if neither
+    is supported for these files, which includes a method copying nothing
+    from a non-empty file, as some FUSE and network file systems do. Raise
+    OSError if the number of bytes copied differs from the file's size.
+    """
+    in_fd = src.fileno()
+    out_fd = dst.fileno()
+    size = os.fstat(in_fd).st_size
+    methods = []
+    if hasattr(os, "copy_file_range"):
+        methods.append(
+            lambda count, offset: os.copy_file_range(
+                in_fd, out_fd, count, offset, offset
+            )
+        )
+    if hasattr(os, "sendfile"):
+        methods.append(lambda count, offset: os.sendfile(out_fd, in_fd, offset, count))
+    for method in methods:
+        copied = 0
+        try:
+            while True:
+                sent = method(KERNEL_COPY_CHUNK, copied)
+                if not sent:
+                    break
+                copied += sent
+        except OSError as err:
+            if copied or err.errno not in ZERO_COPY_UNSUPPORTED:
+                raise
+            continue
+        if copied == size:
+            return True
+        if copied:
+            raise OSError(
+                errno.EIO,
+                "Copied {} of {} bytes from {}".format(copied, size, src.name),
+            )
+    return False
+
+
+def copy_file(
+    source, destination, algorithms=HASH_ALGORITHMS, buffer_size=COPY_BUFFER_SIZE
+):
+    """Copy file and its metadata, returning digests of the data copied.
+
+    The copy is made with a reflink where the file system supports it, in
+    which case the source is only read to hash it, if any digests are
+    needed. When no digests are
+    needed, copy_file_range and sendfile are tried next. Otherwise data is
+    copied and hashed in one pass through a buffer of buffer_size.
+    Raise shutil.SpecialFileError, without opening source, if it is not a
+    regular file (e.g. a named pipe), like shutil.copytree.
+    """
+    _check_regular(source)
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        if _reflink(src, dst):
+            digests = {}
+            if algorithms:
+                digests = _hash_stream(src, algorithms, buffer_size)
+        elif algorithms or not _kernel_copy(src, dst):
+            digests = _hash_stream(src, algorithms, buffer_size, dst)
+        else:
+            digests = {}
+    shutil.copystat(source, destination)
+    os.chmod(destination, FILE_MODE)
+    return digests
+
+
+class Cancelled(Exception):
+    """Processing was cancelled."""
+
+
+def _copy_order(entry):
+    # Files in inode order, which roughly follows their placement on disk,
+    # then subdirectories by name.
+    try:
+        is_dir = entry.is_dir()
+    except OSError:
+        is_dir = False
+    return (is_dir, 0 if is_dir else entry.inode(), entry.name)
+
+
+def _copy_files(files, algorithms, cache, progress, stop):
+    # Copy a shard of (DirEntry, destination, relative path) files.
+    # Return lists of FileRecords and errors.
+    records = []
+    errors = []
+    for entry, dst, rel in files:
+        if stop is not None and stop.is_set():
+            raise Cancelled()
+        src = entry.path
+        try:
+            digests = None
+            if cache is not None:
+                src_stat = entry.stat()
+                digests = cache.get_digests(src, src_stat, algorithms)
+            if digests is None:
+                digests = copy_file(src, dst, algorithms)
+                if cache is not None:
+                    cache.put_digests(src, src_stat, digests)
+            else:
+                copy_file(src, dst, ())
+            record = FileRecord(rel, "r", os.stat(dst), digests)
+            records.append(record)
+            if progress is not None:
+                progress(1, record.size)
+        except OSError as err:
+            errors.append((src, dst, str(err)))
+    return records, errors
+
+
+def copy_tree(
+    source,
+    destination,
+    relpath,
+    algorithms=HASH_ALGORITHMS,
+    cache=None,
+    progress=None,
+    stop=None,
+    workers=1,
+):
+    """Copy directory tree, hashing files in the same pass.
+
+    Behaves like shutil.copytree with symlinks followed, but returns a
+    FileRecord for every directory and file copied, with paths relative to
+    the directory containing destination (i.e. prefixed with relpath).
+    Each directory's files are read in inode order to reduce seeking on
+    spinning disks, before its subdirectories. Files are given FILE_MODE as
+    they are written, and directories DIR_MODE once their files are copied.
+    If a DigestCache is given, files whose digests it holds are copied
+    without hashing and new digests are added to it. If given, progress is
+    called with the number of files and bytes (1, size) after each file is
+    copied. If the stop event is set, Cancelled is raised before the next
+    file is copied. Errors, including special files such as named pipes,
+    which are not opened, are collected and raised together as shutil.Error
+    at the end.
+
+    Each directory's files are split into shards of up to SHARD_BYTES or
+    SHARD_FILES, which are copied by up to workers threads at once. Records
+    are returned in the same order whatever the number of workers.
+    """
+    # Parts of the result, in order: futures of copied shards, and
+    # directories to finish once all files are copied.
+    parts = []
+    errors = []
+    shard = []
+    shard_bytes = 0
+    executor = None
+    if workers > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(workers)
+        # Limit shards waiting to be copied, and the DirEntries they hold.
+        pending = threading.BoundedSemaphore(2 * workers)
+
+    def _flush():
+        nonlocal shard, shard_bytes
+        if not shard:
+            return
+        if executor is None:
+            future = concurrent.futures.Future()
+            future.set_result(_copy_files(shard, algorithms, cache, progress, stop))
+        else:
+            pending.acquire()
+            future = executor.submit(
+                _copy_files, shard, algorithms, cache, progress, stop
+            )
+            future.add_done_callback(lambda future: pending.release())
+        parts.append(future)
+        shard = []
+        shard_bytes = 0
+
+    def _walk(src_dir, dst_dir, rel_dir):
+        nonlocal shard_bytes
+        os.makedirs(dst_dir)
+        try:
+            with os.scandir(src_dir) as it:
+                entries = sorted(it, key=_copy_order)
+        except OSError as err:
+            errors.append((src_dir, dst_dir, str(err)))
+            entries = []
+        for entry in entries:
+            if stop is not None and stop.is_set():
+                raise Cancelled()
+            dst = os.path.join(dst_dir, entry.name)
+            rel = "{}/{}".format(rel_dir, entry.name)
+            try:
+                if entry.is_dir():
+                    _flush()
+                    _walk(entry.path, dst, rel)
+                    continue
+                shard_bytes += entry.stat().st_size
+                shard.append((entry, dst, rel))
+            except OSError as err:
+                errors.append((entry.path, dst, str(err)))
+            if len(shard) >= SHARD_FILES or shard_bytes >= SHARD_BYTES:
+                _flush()
+        _flush()
+        parts.append((src_dir, dst_dir, rel_dir))
+
+    records = []
+    try:
+        _walk(os.path.abspath(source), destination, relpath)
+        _flush()
+        for part in parts:
+            if isinstance(part, concurrent.futures.Future):
+                shard_records, shard_errors = part.result()
+                records.extend(shard_records)
+                errors.extend(shard_errors)
+                continue
+            src_dir, dst_dir, rel_dir = part
+            try:
+                shutil.copystat(src_dir, dst_dir)
+                os.chmod(dst_dir, DIR_MODE)
+            except OSError as err:
+                errors.append((src_dir, dst_dir, str(err)))
+            records.append(FileRecord(rel_dir, "d", os.stat(dst_dir)))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if errors:
+        raise shutil.Error(errors)
+    return records
+
+
+def tree_size(directory):
+    """Return tuple of number and total size of files in directory tree.
+
+    Like copy_tree, symlinks are followed. Unreadable entries are skipped.
+    """
+    files = 0
+    size = 0
+    stack = [directory]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir():
+                            stack.append(entry.path)
+                        else:
+                            files += 1
+                            size += entry.stat().st_size
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return files, size
+
+
+def preflight(directories, workers=8):
+    """Return dict of (files, bytes) totals for each directory.
+
+    The immediate subdirectories of every directory are scanned in
+    parallel, so that a single large folder is also split between workers.
+    """
+    totals = {directory: [0, 0] for directory in directories}
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = {}
+        for directory in directories:
+            try:
+                with os.scandir(directory) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        futures[executor.submit(tree_size, entry.path)] = directory
+                    else:
+                        totals[directory][0] += 1
+                        totals[directory][1] += entry.stat().st_size
+                except OSError:
+                    continue
+        for future in concurrent.futures.as_completed(futures):
+            files, size = future.result()
+            totals[futures[future]][0] += files
+            totals[futures[future]][1] += size
+    return {directory: tuple(total) for directory, total in totals.items()}
+
+
+def source_device(path):
+    """Return ID of the device holding path (st_dev), or None if unknown."""
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+
+def is_rotational(device):
+    """Return True if device is known to be a spinning disk, otherwise False.
+
+    Network shares and other devices missing from sysfs (such as btrfs or
+    device-mapper volumes) count as non-rotational, so that they are not
+    limited to one reader and large folders on them are still sharded.
+    """
+    sys_dir = "/sys/dev/block/{}:{}".format(os.major(device), os.minor(device))
+    # Partitions have no queue of their own; use their disk's.
+    for queue_dir in (sys_dir, os.path.join(sys_dir, "..")):
+        try:
+            with open(os.path.join(queue_dir, "queue", "rotational")) as f:
+                return f.read().strip() != "0"
+        except OSError:
+            continue
+    return False
+
+
+def interleave_by_device(directories):
+    """Return directories reordered to alternate between source devices.
+
+    Directories on the same device keep their order, so that a batch
+    drawing on several devices starts SIPs from all of them side by side
+    rather than working through one device at a time.
+    """
+    groups = {}
+    for directory in directories:
+        groups.setdefault(source_device(directory), []).append(directory)
+    return [
+        directory
+        for batch in itertools.zip_longest(*groups.values())
+        for directory in batch
+        if directory is not None
+    ]
+
+
+def free_space(path):
+    """Return free bytes on the file system that holds or will hold path."""
+    while not os.path.exists(path):
+        path = os.path.dirname(os.path.abspath(path))
+    return shutil.disk_usage(path).free
+
+
+def cache_siegfried_rows(cache, sf_csv, object_dir, source):
+    """Store rows of a Brunnhilde siegfried.csv in cache.
+
+    Rows are keyed by the source file that each copied object came from,
+    with filenames stored relative to object_dir.
+    """
+    source_parent = os.path.dirname(os.path.abspath(source))
+    object_dir = os.path.abspath(object_dir)
+    rows_by_file = {}
+    with open(sf_csv, newline="") as f:
+        for row in csv.DictReader(f):
+            # Files within scanned archives are reported as archive#member.
+            filename = row["filename"]
+            if not os.path.isfile(filename):
+                filename = filename.split("#")[0]
+            row["filename"] = os.path.relpath(row["filename"], object_dir)
+            rows_by_file.setdefault(filename, []).append(row)
+    for filename, rows in rows_by_file.items():
+        source_path = os.path.join(source_parent, os.path.relpath(filename, object_dir))
+        try:
+            cache.put_siegfried(source_path, os.stat(source_path), rows)
+        except OSError:
+            continue
+    cache.commit()
+
+
+def cached_siegfried_rows(cache, records, source, object_dir):
+    """Return cached Siegfried CSV rows (dicts) for the files in records.
+
+    Return tuple of the rows, with filenames under object_dir, and the list
+    of object files that have no cached rows because they are new or have
+    changed since they were identified.
+    """
+    source_parent = os.path.dirname(os.path.abspath(source))
+    object_dir = os.path.abspath(object_dir)
+    rows = []
+    uncached = []
+    for record in records:
+        if record.name_type != "r":
+            continue
+        source_path = os.path.join(source_parent, record.path)
+        try:
+            cached = cache.get_siegfried(source_path, os.stat(source_path))
+        except OSError:
+            cached = None
+        if cached is None:
+            uncached.append(os.path.join(object_dir, *record.path.split("/")))
+            continue
+        for row in cached:
+            row["filename"] = os.path.join(object_dir, row["filename"])
+            rows.append(row)
+    return rows, uncached
+
+
+def siegfried_csv(rows, fieldnames=None):
+    """Return Siegfried CSV text for rows (dicts), sorted by filename.
+
+    Columns are fieldnames if given, otherwise those of the first row.
+    """
+    rows = sorted(rows, key=lambda row: row["filename"])
+    text = io.StringIO()
+    writer = csv.DictWriter(
+        text,
+        fieldnames=fieldnames or list(rows[0]),
+        restval="",
+        extrasaction="ignore",
+        lineterminator="\n",
+    )
+    writer.writeheader()
+    writer.writerows(rows)
+    return text.getvalue()
+
+
+def set_permissions(directory, skip=()):
+    """Apply DIR_MODE and FILE_MODE to directory tree in a single pass.
+
+    Subtrees whose paths are in skip (e.g. objects whose permissions were
+    set by copy_tree) are not descended into. Return number of files and
+    directories changed.
+    """
+    os.chmod(directory, DIR_MODE)
+    changed = 1
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.path in skip:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                changed += set_permissions(entry.path, skip)
+            elif entry.is_file(follow_symlinks=False):
+                os.chmod(entry.path, FILE_MODE)
+                changed += 1
+    return changed
+
+
+def record_totals(records):
+    """Return tuple of number and total size of files in records."""
+    files = 0
+    size = 0
+    for record in records:
+        if record.name_type == "r":
+            files += 1
+            size += record.size
+    return files, size
+
+
+class CommandError(Exception):
+    """External tool failed, timed out or was stopped.
+
+    Has the tool's exit code (negative signal number if it was killed, None
+    if it could not be started), peak memory use in KiB, and the end of its
+    stdout and stderr.
+    """
+
+    def __init__(
+        self, cmd, reason, exit_code=None, max_rss_kb=None, stdout="", stderr=""
+    ):
+        self.cmd = cmd
+        self.exit_code = exit_code
+        self.max_rss_kb = max_rss_kb
+        self.stdout = stdout
+        self.stderr = stderr
+        message = "{} {}".format(os.path.basename(cmd[0]), reason)
+        output = (stderr or stdout).strip()
+        if output:
+            message += ": " + output.splitlines()[-1]
+        super().__init__(message)
+
+
+def _read_tail(pipe, chunks):
+    # Read pipe to the end, keeping the last OUTPUT_TAIL bytes.
+    size = 0
+    with pipe:
+        for chunk in iter(lambda: pipe.read1(OUTPUT_TAIL), b""):
+            chunks.append(chunk)
+            size += len(chunk)
+            while size - len(chunks[0]) >= OUTPUT_TAIL:
+                size -= len(chunks.pop(0))
+
+
+def _signal_group(pgid, signum):
+    try:
+        os.killpg(pgid, signum)
+    except ProcessLookupError:
+        pass
+
+
+def run_command(cmd, timeout=None, stop=None):
+    """Run command, an argument list, and wait for it to exit.
+
+    stdout and stderr are read concurrently, so that neither pipe can fill
+    up and block the tool. The command runs in its own process group, which
+    is terminated if it runs for longer than timeout seconds or if the stop
+    event is set.
+
+    Return tuple of exit code and peak resident set size of the child
+    process in KiB. Raise CommandError if the command cannot be started,
+    exits with a nonzero code, times out or is stopped.
+    """
+    if stop is not None and stop.is_set():
+        raise CommandError(cmd, "was stopped")
+    try:
+        proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+    except OSError as err:
+        raise CommandError(cmd, "could not be started ({})".format(err))
+    outputs = ([], [])
+    readers = [
+        threading.Thread(target=_read_tail, args=(pipe, chunks), daemon=True)
+        for pipe, chunks in zip((proc.stdout, proc.stderr), outputs)
+    ]
+    for reader in readers:
+        reader.start()
+
+    start = time.monotonic()
+    reason = None
+    kill_at = None
+    interval = 0.01
+    while True:
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            break
+        now = time.monotonic()
+        if reason is None:
+            if stop is not None and stop.is_set():
+                reason = "was stopped"
+            elif timeout is not None and now - start > timeout:
+                reason = "timed out after {} seconds".format(timeout)
+            if reason is not None:
+                _signal_group(proc.pid, signal.SIGTERM)
+                kill_at = now + KILL_GRACE
+        elif now > kill_at:
+            _signal_group(proc.pid, signal.SIGKILL)
+            kill_at = float("inf")
+        time.sleep(interval)
+        interval = min(interval * 2, 0.5)
+
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    if reason is not None:
+        # Do not wait for output from children that outlived the kill.
+        _signal_group(proc.pid, signal.SIGKILL)
+    for reader in readers:
+        reader.join()
+    if reason is None and proc.returncode:
+        reason = "exited with code {}".format(proc.returncode)
+    if reason is not None:
+        stdout, stderr = (
+            b"".join(chunks).decode("utf-8", "replace") for chunks in outputs
+        )
+        raise CommandError(
+            cmd, reason, proc.returncode, rusage.ru_maxrss, stdout, stderr
+        )
+    return proc.returncode, rusage.ru_maxrss
+
+
+def hash_file(path, algorithms=HASH_ALGORITHMS, buffer_size=COPY_BUFFER_SIZE):
+    """Return dict of hex digests of file.
+
+    Raise shutil.SpecialFileError if path is not a regular file.
+    """
+    _check_regular(path)
+    with open(path, "rb") as f:
+        return _hash_stream(f, algorithms, buffer_size)
+
+
+def scan_tree(directory, relpath, workers=None, algorithms=HASH_ALGORITHMS, stop=None):
+    """Yield FileRecords for an existing directory tree.
+
+    Paths and order match copy_tree. The tree is listed with os.scandir and
+    files are hashed in a pool of up to workers threads. If the stop event
+    is set, Cancelled is raised before the next file is hashed.
+    """
+    entries = []
+
+    def _list_dir(dir_path, rel_dir):
+        if stop is not None and stop.is_set():
+            raise Cancelled()
+        with os.scandir(dir_path) as it:
+            children = sorted(it, key=_copy_order)
+        for entry in children:
+            rel = "{}/{}".format(rel_dir, entry.name)
+            if entry.is_dir():
+                _list_dir(entry.path, rel)
+            else:
+                entries.append((entry.path, rel, "r"))
+        entries.append((dir_path, rel_dir, "d"))
+
+    def _record(entry):
+        if stop is not None and stop.is_set():
+            raise Cancelled()
+        path, rel, name_type = entry
+        if name_type == "r":
+            digests = hash_file(path, algorithms)
+            return FileRecord(rel, name_type, os.stat(path), digests)
+        return FileRecord(rel, name_type, os.stat(path))
+
+    _list_dir(directory, relpath)
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        for record in executor.map(_record, entries):
+            yield record
+
+
+def record_to_fileobject(record):
+    """Convert FileRecord to Objects.FileObject."""
+    fileobject = Objects.FileObject()
+    fileobject.filename = record.path
+    fileobject.name_type = record.name_type
+    fileobject.filesize = record.size
+    fileobject.alloc = True
+    fileobject.inode = record.inode
+    fileobject.mode = record.mode
+    fileobject.nlink = record.nlink
+    fileobject.uid = record.uid
+    fileobject.gid = record.gid
+    fileobject.mtime = record.mtime
+    fileobject.atime = record.atime
+    fileobject.ctime = record.ctime
+    for algorithm in ("md5", "sha256", "sha512"):
+        digest = getattr(record, algorithm)
+        if digest:
+            setattr(fileobject, algorithm, digest)
+    return fileobject
+
+
+def write_dfxml(records, dfxml_path):
+    """Stream DFXML describing records to dfxml_path.
+
+    Each FileObject is serialized and written as its record arrives, so
+    records may be a generator such as scan_tree. Returns the list of
+    records written.
+    """
+    dfxml = Objects.DFXMLObject(version="1.1.1")
+    dfxml.program = "CCA Folder Processor"
+    dfxml.program_version = VERSION
+    wrapper = ET.tostring(
+        dfxml.to_partial_Element(), encoding="unicode", short_empty_elements=False
+    )
+    head, sep, foot = wrapper.rpartition("</")
+    written = []
+    with open(dfxml_path, "w") as f:
+        f.write('<?xml version="1.0"?>\n')
+        f.write(head)
+        f.write("\n")
+        for record in records:
+            element = record_to_fileobject(record).to_Element()
+            f.write(ET.tostring(element, encoding="unicode"))
+            f.write("\n")
+            written.append(record)
+        f.write(sep + foot)
+    return written
+
+
+def write_checksum_manifest(records, manifest_path, prefix="../objects"):
+    """Write md5deep-style (-rl) manifest of file records."""
+    with open(manifest_path, "w") as f:
+        for record in records:
+            if record.name_type == "r":
+                f.write("{}  {}/{}\n".format(record.md5, prefix, record.path))
+
+
+def read_manifest(manifest_path, prefix, escaped=False):
+    """Return dict of digests in an md5deep-style or bag manifest.
+
+    Only entries under prefix are read, keyed by their path below it. Bag
+    manifests have newlines in paths percent-encoded; pass escaped=True to
+    decode them.
+    """
+    prefix = prefix.rstrip("/") + "/"
+    digests = {}
+    with open(manifest_path, encoding="utf-8") as f:
+        for line in f:
+            digest, _, path = line.rstrip("\n").partition(" ")
+            path = path.lstrip(" ")
+            if escaped:
+                path = path.replace("%0A", "\n").replace("%0D", "\r")
+            if path.startswith(prefix):
+                digests[path[len(prefix) :]] = digest.lower()
+    return digests
+
+
+def verify_objects(expected, manifest, objects_dir, algorithm, workers=None, stop=None):
+    """Check object files against source digests and the SIP's manifest.
+
+    expected and manifest are dicts of digests keyed by path relative to
+    objects_dir. Only the files in objects_dir are read, hashed in a pool of
+    up to workers threads. If the stop event is set, Cancelled is raised
+    before the next file is hashed. Return list of problems sorted by path,
+    each a dict with FIXITY_FIELDS as keys.
+    """
+    problems = []
+
+    def problem(*values):
+        problems.append(
+            dict(itertools.zip_longest(FIXITY_FIELDS, values, fillvalue=""))
+        )
+
+    found = set(manifest)
+    for dirpath, dirnames, filenames in os.walk(objects_dir):
+        if stop is not None and stop.is_set():
+            raise Cancelled()
+        rel_dir = os.path.relpath(dirpath, objects_dir).replace(os.sep, "/")
+        for filename in filenames:
+            found.add(filename if rel_dir == "." else rel_dir + "/" + filename)
+    for path in found.difference(expected):
+        problem(path, "not in source", "", manifest.get(path, ""))
+    for path, digest in expected.items():
+        if path not in manifest:
+            problem(path, "not in manifest", digest)
+        elif manifest[path] != digest:
+            problem(path, "manifest mismatch", digest, manifest[path])
+
+    def _hash(path):
+        if stop is not None and stop.is_set():
+            raise Cancelled()
+        try:
+            full_path = os.path.join(objects_dir, *path.split("/"))
+            return path, hash_file(full_path, (algorithm,))[algorithm], None
+        except OSError as err:
+            return path, None, err
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        for path, digest, err in executor.map(_hash, sorted(expected)):
+            if isinstance(err, FileNotFoundError):
+                problem(path, "missing", expected[path])
+            elif err is not None:
+                problem(path, "unreadable ({})".format(err), expected[path])
+            elif digest != expected[path]:
+                problem(path, "mismatch", expected[path], digest)
+    problems.sort(key=lambda problem: problem["path"])
+    return problems
+
+
+def write_fixity_report(problems, report_path):
+    """Write fixity problems as CSV. No rows means every file matched."""
+    os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    tmp_path = report_path + ".tmp"
+    with open(tmp_path, "w", newline="") as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow(FIXITY_HEADERS)
+        for problem in problems:
+            writer.writerow([problem[field] for field in FIXITY_FIELDS])
+    os.replace(tmp_path, report_path)
+
+
+def read_fixity_report(report_path):
+    """Return list of problems in fixity report, or None if there is none."""
+    if not os.path.isfile(report_path):
+        return None
+    with open(report_path, newline="") as f:
+        reader = csv.reader(f)
+        next(reader)
+        return [dict(zip(FIXITY_FIELDS, row)) for row in reader]
+
+
+class DFXMLFileObject(object):
+    """Compact record of selected properties of a DFXML fileobject.
+
+    Properties that were not requested from read_fileobjects are None.
+    Digests are named by hash type, e.g. md5.
+    """
+
+    __slots__ = FILEOBJECT_FIELDS
+
+    def __init__(self):
+        for field in FILEOBJECT_FIELDS:
+            setattr(self, field, None)
+
+
+def read_fileobjects(dfxml_file, fields=("name_type", "mtime", "filesize")):
+    """Yield a DFXMLFileObject for each fileobject in DFXML file.
+
+    A lighter alternative to Objects.iterparse: only the listed fields are
+    read, and each fileobject element is detached from the tree once read,
+    so memory use does not grow with the number of fileobjects.
+    """
+    fields = frozenset(fields)
+    unknown = fields.difference(FILEOBJECT_FIELDS)
+    if unknown:
+        raise ValueError("Unknown fileobject fields: {}".format(sorted(unknown)))
+    fileobject = None
+    # Depth within the current fileobject, and open elements outside it.
+    depth = 0
+    ancestors = []
+    # Names without namespace, computed once per distinct tag.
+    local_names = {}
+    for event, element in ET.iterparse(dfxml_file, events=("start", "end")):
+        tag = local_names.get(element.tag)
+        if tag is None:
+            tag = local_names[element.tag] = element.tag.rpartition("}")[2]
+        if event == "start":
+            if tag == "fileobject" and not depth:
+                fileobject = DFXMLFileObject()
+            if depth or tag == "fileobject":
+                depth += 1
+            else:
+                ancestors.append(element)
+            continue
+        if not depth:
+            ancestors.pop()
+            continue
+        depth -= 1
+        if depth == 1:
+            if tag == "hashdigest":
+                tag = element.get("type", "").lower()
+            if tag in fields:
+                value = element.text
+                if tag == "filesize":
+                    value = int(value or 0)
+                setattr(fileobject, tag, value)
+        elif not depth:
+            if ancestors:
+                ancestors[-1].remove(element)
+            yield fileobject
+
+
+def dfxml_file_stats(dfxml_file):
+    """Yield (name_type, mtime, filesize) for fileobjects in DFXML file."""
+    for fileobject in read_fileobjects(dfxml_file):
+        yield (
+            fileobject.name_type,
+            fileobject.mtime or "",
+            fileobject.filesize or 0,
+        )
+
+
+class SIPStats(object):
+    """Running totals of files, bytes and modified dates for a SIP."""
+
+    __slots__ = ("file_count", "total_bytes", "earliest", "latest")
+
+    def __init__(self):
+        self.file_count = 0
+        self.total_bytes = 0
+        self.earliest = None
+        self.latest = None
+
+    def add(self, name_type, mtime, filesize):
+        """Add file to totals, skipping directories and links."""
+        if name_type and name_type != "r":
+            return
+        self.file_count += 1
+        self.total_bytes += filesize
+        if self.earliest is None or mtime < self.earliest:
+            self.earliest = mtime
+        if self.latest is None or mtime > self.latest:
+            self.latest = mtime
+
+
+def make_bag(sip_dir, records, workers=None, algorithms=BAG_ALGORITHMS):
+    """Convert SIP directory into a bag in place.
+
+    objects/ and metadata/ are renamed into data/, so no payload is copied.
+    Digests of object files are taken from records when present; everything
+    else in the payload is hashed in a pool of up to workers threads.
+    Returns the resulting bagit.Bag.
+    """
+    data_dir = os.path.join(sip_dir, "data")
+    os.makedirs(data_dir, exist_ok=True)
+    for name in ("objects", "metadata"):
+        # Already moved if an earlier, interrupted make_bag got that far.
+        if os.path.isdir(os.path.join(sip_dir, name)):
+            os.rename(os.path.join(sip_dir, name), os.path.join(data_dir, name))
+
+    # Collect (payload path, digests) for every payload file, reusing
+    # copy-time digests where the record has all the algorithms needed.
+    payload = []
+    to_hash = []
+    for record in records:
+        if record.name_type != "r":
+            continue
+        path = "data/objects/{}".format(record.path)
+        digests = {algorithm: getattr(record, algorithm) for algorithm in algorithms}
+        if all(digests.values()):
+            payload.append((path, digests, record.size))
+        else:
+            to_hash.append(path)
+    for dirpath, dirnames, filenames in os.walk(os.path.join(data_dir, "metadata")):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            to_hash.append(os.path.relpath(path, sip_dir).replace(os.sep, "/"))
+
+    def _hash(path):
+        full_path = os.path.join(sip_dir, path)
+        return path, hash_file(full_path, algorithms), os.path.getsize(full_path)
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        payload.extend(executor.map(_hash, to_hash))
+    payload.sort()
+
+    for algorithm in algorithms:
+        manifest_path = os.path.join(sip_dir, "manifest-{}.txt".format(algorithm))
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            for path, digests, size in payload:
+                path = path.replace("\r", "%0D").replace("\n", "%0A")
+                f.write("{}  {}\n".format(digests[algorithm], path))
+
+    with open(os.path.join(sip_dir, "bagit.txt"), "w", encoding="utf-8") as f:
+        f.write("BagIt-Version: 0.97\nTag-File-Character-Encoding: UTF-8\n")
+
+    bag_info = {
+        "Bag-Software-Agent": "CCA Folder Processor v{}".format(VERSION),
+        "Bagging-Date": datetime.date.today().strftime("%Y-%m-%d"),
+        "Payload-Oxum": "{}.{}".format(
+            sum(size for path, digests, size in payload), len(payload)
+        ),
+    }
+    with open(os.path.join(sip_dir, "bag-info.txt"), "w", encoding="utf-8") as f:
+        for key in sorted(bag_info):
+            f.write("{}: {}\n".format(key, bag_info[key]))
+
+    tag_files = ["bagit.txt", "bag-info.txt"] + [
+        "manifest-{}.txt".format(algorithm) for algorithm in algorithms
+    ]
+    for algorithm in algorithms:
+        tagmanifest_path = os.path.join(sip_dir, "tagmanifest-{}.txt".format(algorithm))
+        with open(tagmanifest_path, "w", encoding="utf-8") as f:
+            for tag_file in tag_files:
+                digests = hash_file(os.path.join(sip_dir, tag_file), (algorithm,))
+                f.write("{} {}\n".format(digests[algorithm], tag_file))
+
+    return bagit.Bag(sip_dir)
+
+
+def _metadata_path(sip_path, bag_files, *parts):
+    if bag_files:
+        return os.path.join(sip_path, "data", "metadata", *parts)
+    return os.path.join(sip_path, "metadata", *parts)
+
+
+def sip_stats(sip_path, bag_files, records=None):
+    """Return SIPStats for SIP directory.
+
+    File statistics come from records (FileRecords for the SIP's objects)
+    when given, otherwise from the SIP's DFXML file.
+    """
+    if records is None:
+        dfxml_file = os.path.abspath(
+            _metadata_path(sip_path, bag_files, "submissionDocumentation", "dfxml.xml")
+        )
+        stats = dfxml_file_stats(dfxml_file)
+    else:
+        stats = ((record.name_type, record.mtime, record.size) for record in records)
+    result = SIPStats()
+    for name_type, mtime, filesize in stats:
+        result.add(name_type, mtime or "", filesize)
+    return result
+
+
+def read_formats(sip_path, bag_files, limit=None):
+    """Return list of (format, puid, count) from SIP's Brunnhilde formats.csv.
+
+    Formats are in the report's order, most common first.
+    """
+    fileformat_csv = _metadata_path(
+        sip_path,
+        bag_files,
+        "submissionDocumentation",
+        "brunnhilde",
+        "csv_reports",
+        "formats.csv",
+    )
+    formats = []
+    with open(fileformat_csv, "r") as f:
+        reader = csv.reader(f)
+        next(reader)
+        for row in itertools.islice(reader, limit):
+            count = int(row[2]) if len(row) > 2 and row[2].isdigit() else None
+            formats.append((row[0], row[1] if len(row) > 1 else "", count))
+    return formats
+
+
+def build_csv_row(
+    sip_path, bag_files, records=None, stats=None, formats=None, general_note=""
+):
+    """Return description CSV row for SIP directory.
+
+    File statistics come from stats (a SIPStats) and formats from formats
+    (as returned by read_formats) when given, otherwise they are read as in
+    sip_stats and read_formats.
+    """
+    if stats is None:
+        stats = sip_stats(sip_path, bag_files, records)
+    file_count = stats.file_count
+
+    # Build extent statement.
+    size_readable = convert_size(stats.total_bytes)
+    extent = "EMPTY"
+    if file_count == 1:
+        extent = "1 digital file ({})".format(size_readable)
+    if file_count > 1:
+        extent = "{} digital files ({})".format(file_count, size_readable)
+
+    # Build date statement from modified dates.
+    date_earliest = "N/A"
+    date_latest = "N/A"
+    if file_count:
+        date_earliest = stats.earliest[:10]
+        date_latest = stats.latest[:10]
+    date_statement = "{}-{}".format(date_earliest[:4], date_latest[:4])
+    if date_earliest[:4] == date_latest[:4]:
+        date_statement = date_earliest[:4]
+
+    # Write scope and content note from information in brunnhilde reports.
+    scope_content = ""
+    if extent != "EMPTY":
+        if formats is None:
+            formats = read_formats(sip_path, bag_files, 5)
+        file_formats = [format_ or "Unidentified" for format_, _, _ in formats[:5]]
+        formats_list = ", ".join(file_formats)
+        scope_content = 'Original directory name: "{}". Most common file formats: {}'.format(
+            os.path.basename(sip_path), formats_list
+        )
+
+    return [
+        "",
+        os.path.basename(sip_path),
+        "",
+        "",
+        date_statement,
+        date_earliest,
+        date_latest,
+        "File",
+        extent,
+        scope_content,
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        general_note,
+        "",
+    ]
+
+
+def fixity_note(problems, report_path):
+    """Return description note flagging a SIP's fixity problems, if any."""
+    if not problems:
+        return ""
+    return "Fixity check failed for {} file(s); see {}.".format(
+        len(set(problem["path"] for problem in problems)), report_path
+    )
+
+
+def build_summary(sip_path, bag_files, stats, formats, fixity=None):
+    """Return machine-readable summary of SIP directory as a dict.
+
+    Unlike the description CSV row, values are left unformatted: byte and
+    file counts are integers, dates are full ISO 8601 timestamps, and the
+    format histogram lists every format in the Brunnhilde report.
+    fixity_problems is the number of problems found by the verify stage
+    (see verify_objects), or None if the SIP was not verified.
+    """
+    if bag_files:
+        manifests = sorted(
+            name
+            for name in os.listdir(sip_path)
+            if name.startswith("manifest-") and name.endswith(".txt")
+        )
+    else:
+        manifests = [os.path.join("metadata", "checksum.md5")]
+    return {
+        "sip": os.path.basename(sip_path),
+        "path": os.path.abspath(sip_path),
+        "bagged": bool(bag_files),
+        "file_count": stats.file_count,
+        "total_bytes": stats.total_bytes,
+        "earliest_mtime": stats.earliest if stats.file_count else None,
+        "latest_mtime": stats.latest if stats.file_count else None,
+        "formats": [
+            {"format": format_, "puid": puid, "count": count}
+            for format_, puid, count in formats
+        ],
+        "checksum_manifests": manifests,
+        "fixity_problems": None if fixity is None else len(fixity),
+    }
+
+
+class DescriptionWriter(object):
+    """Incrementally maintained description CSV.
+
+    Each SIP's row is built once, when the SIP is added, and kept in memory,
+    so describing a new SIP never re-parses the DFXML or Brunnhilde reports
+    of SIPs already described. The CSV is atomically rewritten after each
+    addition with rows sorted by SIP name.
+
+    A summary.jsonl file next to the CSV is rewritten alongside it, with one
+    build_summary object per SIP, for tools that aggregate many SIPs.
+    """
+
+    def __init__(self, csv_path, bag_files):
+        self.csv_path = csv_path
+        self.summary_path = os.path.join(os.path.dirname(csv_path), SUMMARY_FILENAME)
+        self.bag_files = bag_files
+        self.rows = {}
+        self.summaries = {}
+
+    def add(self, sip_path, records=None, fixity=None, fixity_report=""):
+        """Build row and summary for SIP, rewrite files and return the row.
+
+        fixity is the list of problems in the SIP's fixity report at
+        fixity_report, or None if the SIP was not verified. Problems are
+        flagged in the row's general note.
+        """
+        stats = sip_stats(sip_path, self.bag_files, records)
+        formats = []
+        if stats.file_count:
+            formats = read_formats(sip_path, self.bag_files)
+        sip_name = os.path.basename(sip_path)
+        row = build_csv_row(
+            sip_path,
+            self.bag_files,
+            stats=stats,
+            formats=formats,
+            general_note=fixity_note(fixity, fixity_report),
+        )
+        self.rows[sip_name] = row
+        self.summaries[sip_name] = build_summary(
+            sip_path, self.bag_files, stats, formats, fixity
+        )
+        self.write()
+        return row
+
+    def write(self):
+        """Write CSV and summaries to temporary files and move them into place."""
+        tmp_path = self.csv_path + ".tmp"
+        with open(tmp_path, "w") as csv_file:
+            writer = csv.writer(csv_file, quoting=csv.QUOTE_NONNUMERIC)
+            writer.writerow(CSV_HEADERS)
+            for sip_name in sorted(self.rows):
+                writer.writerow(self.rows[sip_name])
+        os.replace(tmp_path, self.csv_path)
+
+        tmp_path = self.summary_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for sip_name in sorted(self.summaries):
+                f.write(json.dumps(self.summaries[sip_name], sort_keys=True) + "\n")
+        os.replace(tmp_path, self.summary_path)
+
+
+class ByteBudget(object):
+    """Limit on the bytes of SIPs in progress, i.e. copied but unfinished.
+
+    A SIP larger than the whole budget may start when no other SIP is in
+    progress. A limit of None means no limit.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        """Wait until size bytes fit in the budget, then take them."""
+        with self.condition:
+            while (
+                self.limit is not None and self.used and self.used + size > self.limit
+            ):
+                self.condition.wait()
+            self.used += size
+
+    def release(self, size):
+        """Return size bytes to the budget."""
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+class MetricsLog(object):
+    """JSON-lines log of per-stage metrics for each SIP.
+
+    Each entry is appended to the log as soon as its stage finishes. Totals
+    per stage are kept for the summary shown at the end of a run.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.totals = {}
+
+    def add(self, entry):
+        """Append entry to log and add it to stage totals."""
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+            totals = self.totals.setdefault(
+                entry["stage"],
+                {"sips": 0, "seconds": 0.0, "files": 0, "bytes": 0, "max_rss_kb": 0},
+            )
+            totals["sips"] += 1
+            totals["seconds"] += entry["seconds"]
+            totals["files"] += entry.get("files") or 0
+            totals["bytes"] += entry.get("bytes") or 0
+            totals["max_rss_kb"] = max(
+                totals["max_rss_kb"], entry.get("max_rss_kb") or 0
+            )
+
+    def summary(self):
+        """Return dict of totals per stage, with throughput in MB/s."""
+        with self.lock:
+            summary = {}
+            for stage, totals in self.totals.items():
+                totals = dict(totals)
+                totals["mb_per_s"] = throughput(totals["bytes"], totals["seconds"])
+                summary[stage] = totals
+            return summary
+
+
+class Progress(object):
+    """Files and bytes copied so far in a batch, with throughput and ETA.
+
+    advance returns a "progress" event at most every interval seconds, and
+    always when the batch total is reached.
+    """
+
+    def __init__(self, files_total, bytes_total, interval=0.5):
+        self.files_total = files_total
+        self.bytes_total = bytes_total
+        self.files_done = 0
+        self.bytes_done = 0
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.last_event = None
+
+    def advance(self, files, size):
+        """Add files and bytes done. Return progress event or None."""
+        with self.lock:
+            self.files_done += files
+            self.bytes_done += size
+            now = time.monotonic()
+            finished = (
+                self.files_done >= self.files_total
+                and self.bytes_done >= self.bytes_total
+            )
+            if (
+                not finished
+                and self.last_event is not None
+                and now - self.last_event < self.interval
+            ):
+                return None
+            self.last_event = now
+            return self.event(now)
+
+    def event(self, now=None):
+        """Return progress event for the current totals."""
+        if now is None:
+            now = time.monotonic()
+        elapsed = now - self.start
+        eta = None
+        if self.bytes_done and self.bytes_total:
+            remaining = max(self.bytes_total - self.bytes_done, 0)
+            eta = round(elapsed * remaining / self.bytes_done)
+        elif self.files_done and self.files_total:
+            remaining = max(self.files_total - self.files_done, 0)
+            eta = round(elapsed * remaining / self.files_done)
+        return {
+            "event": "progress",
+            "files_done": self.files_done,
+            "files_total": self.files_total,
+            "bytes_done": self.bytes_done,
+            "bytes_total": self.bytes_total,
+            "mb_per_s": throughput(self.bytes_done, elapsed),
+            "eta_seconds": eta,
+        }
+
+
+def throughput(size, seconds):
+    """Return throughput in MB/s, or None if it cannot be measured."""
+    if not size or seconds <= 0:
+        return None
+    return round(size / 1000000 / seconds, 2)
+
+
+def format_summary(summary):
+    """Return human-readable text for MetricsLog.summary."""
+    lines = []
+    for stage, totals in summary.items():
+        line = "{}: {:.1f} s for {} SIP(s)".format(
+            stage, totals["seconds"], totals["sips"]
+        )
+        if totals["bytes"]:
+            line += ", {}".format(convert_size(totals["bytes"]))
+        if totals["mb_per_s"]:
+            line += " at {} MB/s".format(totals["mb_per_s"])
+        if totals["max_rss_kb"]:
+            line += ", peak RSS {}".format(convert_size(totals["max_rss_kb"] * 1024))
+        lines.append(line)
+    return "\n".join(lines)
+
+
+class Journal(object):
+    """Job journal recording the create_sip stages each SIP has completed.
+
+    The journal is saved as JSON after every change, so that rerunning an
+    interrupted batch with the same output directory skips finished work.
+    A SIP's description row and summary are kept with its "describe" stage.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.sips = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.sips = json.load(f)["sips"]
+
+    def begin(self, sip_name, source, exists=False):
+        """Start (or restart) journal entry for SIP.
+
+        Return False if the journal already has a SIP of the same name
+        created from a different source, or if exists (the SIP directory is
+        already there) and the journal did not begin it from source.
+        """
+        with self.lock:
+            entry = self.sips.get(sip_name)
+            known = entry is not None and entry.get("source") == source
+            if (entry is not None or exists) and not known:
+                return False
+            self.sips[sip_name] = {"source": source, "stages": []}
+            self.save()
+        return True
+
+    def source(self, sip_name):
+        """Return source SIP was begun from, or None if it is not known."""
+        with self.lock:
+            return self.sips.get(sip_name, {}).get("source")
+
+    def forget(self, sip_name):
+        """Remove SIP's entry, so that it is created from scratch next time."""
+        with self.lock:
+            if self.sips.pop(sip_name, None) is not None:
+                self.save()
+
+    def fail(self, sip_name, message):
+        """Record that SIP failed with message. begin clears the failure."""
+        with self.lock:
+            self.sips.setdefault(sip_name, {"stages": []})["error"] = message
+            self.save()
+
+    def done(self, sip_name, stage):
+        """Return True if SIP has completed stage."""
+        with self.lock:
+            return stage in self.sips.get(sip_name, {}).get("stages", [])
+
+    def record(self, sip_name, stage, row=None, summary=None):
+        """Record that SIP has completed stage, clearing any failure."""
+        with self.lock:
+            entry = self.sips.setdefault(sip_name, {"stages": []})
+            entry["stages"].append(stage)
+            entry.pop("error", None)
+            if row is not None:
+                entry["row"] = row
+            if summary is not None:
+                entry["summary"] = summary
+            self.save()
+
+    def rows(self):
+        """Return dict of description rows keyed by SIP name."""
+        with self.lock:
+            return {
+                sip_name: entry["row"]
+                for sip_name, entry in self.sips.items()
+                if "row" in entry
+            }
+
+    def summaries(self):
+        """Return dict of SIP summaries keyed by SIP name."""
+        with self.lock:
+            return {
+                sip_name: entry["summary"]
+                for sip_name, entry in self.sips.items()
+                if "summary" in entry
+            }
+
+    def save(self):
+        """Write journal to temporary file and move it into place."""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"sips": self.sips}, f)
+        os.replace(tmp_path, self.path)
+
+
+class SIPProcessor(object):
+    """Create SIPs and write descriptive CSV.
+
+    Progress is reported by calling report with event dicts, each with an
+    "event" key:
+
+    - "sip_done": a source directory has been processed ("source", "sip",
+      and "status", one of "ok", "failed", "cancelled" or "skipped"; a
+      cancelled SIP that was moved aside also has its new path as
+      "incomplete").
+    - "preflight": source directories have been sized ("files", "bytes",
+      and "free_bytes" at the destination).
+    - "warning": a problem that does not stop processing ("message").
+    - "progress": files have been copied (see Progress.event). Progress
+      and its ETA cover copying only.
+    - "stage": a SIP has started or finished a create_sip stage ("sip",
+      "stage", and "state", "started" or "finished"), so that the stages
+      still running once copying is done can be shown.
+    - "error": a SIP could not be created or described ("sip", "message").
+    - "done": the batch is finished ("total", "failed", "cancelled", and
+      "stages", the per-stage totals of MetricsLog.summary).
+
+    Metrics for every stage of every SIP are appended to metrics.jsonl in
+    output_dir.
+    """
+
+    def __init__(
+        self,
+        dirs_to_process,
+        destination,
+        bag_files,
+        scan_for_pii,
+        output_dir,
+        workers=1,
+        stage_limits=None,
+        report=None,
+        cache_path=None,
+        cache_max_age_days=MAX_AGE_DAYS,
+        cache_max_entries=MAX_ENTRIES,
+        shared_siegfried=True,
+        pii_threads=None,
+        pipeline_depth=PIPELINE_DEPTH,
+        max_pending_bytes=None,
+        device_readers=None,
+        tool_timeouts=None,
+        verify=False,
+    ):
+        self.dirs_to_process = dirs_to_process
+        self.destination = destination
+        self.bag_files = bag_files
+        self.scan_for_pii = scan_for_pii
+        self.output_dir = output_dir
+        self.workers = max(1, workers)
+        self.pipeline_depth = max(1, pipeline_depth)
+        limits = dict(STAGE_LIMITS)
+        limits.update(stage_limits or {})
+        self.stage_semaphores = {
+            name: threading.BoundedSemaphore(
+                min(limit, self.workers) if limit else self.workers
+            )
+            for name, limit in limits.items()
+        }
+        self.max_pending_bytes = max_pending_bytes
+        self.budget = ByteBudget(max_pending_bytes)
+        self.device_readers = device_readers
+        self.device_semaphores = {}
+        self.device_lock = threading.Lock()
+        self.tool_timeouts = dict(TOOL_TIMEOUTS)
+        self.tool_timeouts.update(tool_timeouts or {})
+        self.verify = verify
+        self.cancelled = threading.Event()
+        # Stop events of the SIPs in progress, set by cancel.
+        self.stops = set()
+        self.stops_lock = threading.Lock()
+        self.incomplete = {}
+        self.journal = Journal(os.path.join(output_dir, JOURNAL_FILENAME))
+        self.metrics = MetricsLog(os.path.join(output_dir, METRICS_FILENAME))
+        self.sizes = {}
+        self.progress = Progress(0, 0)
+        self.report = report or (lambda event: None)
+        self.cache_path = cache_path
+        self.cache = None
+        if cache_path:
+            self.cache = DigestCache(cache_path)
+        self.cache_max_age_days = cache_max_age_days
+        self.cache_max_entries = cache_max_entries
+        self.shared_siegfried = shared_siegfried
+        self.pii_threads = pii_threads
+        self.siegfried = None
+
+    def cancel(self):
+        """Cancel processing.
+
+        No new SIP or stage is started, copies stop before their next file,
+        and running tools are stopped. SIPs in progress are moved aside by
+        quarantine. Safe to call from any thread or a signal handler.
+        """
+        self.cancelled.set()
+        with self.stops_lock:
+            for stop in self.stops:
+                stop.set()
+
+    def quarantine(self, sip_name):
+        """Move incomplete SIP out of the destination and forget its progress.
+
+        The SIP is moved into the INCOMPLETE_DIRNAME folder next to the
+        destination, where it cannot be mistaken for a finished SIP, and is
+        created from scratch when the job is run again.
+        """
+        sip_dir = os.path.join(self.destination, sip_name)
+        if os.path.isdir(sip_dir):
+            incomplete_dir = os.path.join(
+                os.path.dirname(os.path.abspath(self.destination)), INCOMPLETE_DIRNAME
+            )
+            os.makedirs(incomplete_dir, exist_ok=True)
+            target = os.path.join(
+                incomplete_dir,
+                "{}-{}".format(sip_name, time.strftime("%Y%m%dT%H%M%S")),
+            )
+            shutil.move(sip_dir, target)
+            self.incomplete[sip_name] = target
+        self.journal.forget(sip_name)
+
+    def advance_progress(self, files, size):
+        """Add files and bytes copied, reporting progress if due."""
+        event = self.progress.advance(files, size)
+        if event is not None:
+            self.report(event)
+
+    def identify(self, sip_name, object_dir, source, records, stop=None):
+        """Write Siegfried CSV for SIP objects to a temporary file.
+
+        Rows of files unchanged since they were last identified come from
+        the cache. Only the other files are sent to the shared Siegfried
+        server, one request each, unless most files need identifying, in
+        which case the whole tree is. Return the file's path, or None if
+        Brunnhilde should run Siegfried itself (or the stop event was set
+        while waiting for the server).
+        """
+        if self.siegfried is None:
+            return None
+        rows = []
+        uncached = None
+        if self.cache is not None and records is not None:
+            rows, uncached = cached_siegfried_rows(
+                self.cache, records, source, object_dir
+            )
+        options = {"timeout": self.tool_timeouts.get("sf"), "stop": stop}
+        try:
+            if uncached is None or 2 * len(uncached) > record_totals(records)[0]:
+                text = self.siegfried.identify_tree(
+                    os.path.abspath(object_dir), self.shards(source), **options
+                )
+            elif uncached:
+                text = self.siegfried.identify_paths(
+                    uncached, self.shards(source), **options
+                )
+                reader = csv.DictReader(io.StringIO(text))
+                rows.extend(reader)
+                text = siegfried_csv(rows, reader.fieldnames)
+            elif rows:
+                text = siegfried_csv(rows)
+            else:
+                return None
+        except OSError as err:
+            if stop is not None and stop.is_set():
+                return None
+            self.report({"event": "warning", "message": str(err)})
+            return None
+        fd, path = tempfile.mkstemp(
+            prefix=sip_name + "-", suffix=".csv", dir=self.output_dir
+        )
+        with os.fdopen(fd, "w", newline="") as f:
+            f.write(text)
+        return path
+
+    def run_tool(self, cmd, stop=None):
+        """Run external tool with its timeout from tool_timeouts.
+
+        See run_command.
+        """
+        return run_command(cmd, self.tool_timeouts.get(cmd[0]), stop)
+
+    def scan_pii(self, sip_name, objects_path, output_dir, stop=None):
+        """Scan objects for PII with bulk_extractor.
+
+        Raise CommandError if the scan fails or is stopped.
+        """
+        if os.path.isdir(output_dir):
+            shutil.rmtree(output_dir)
+        cmd = ["bulk_extractor", "-S", "ssn_mode=1", "-o", output_dir]
+        if self.pii_threads:
+            cmd += ["-j", str(self.pii_threads)]
+        cmd += ["-R", objects_path]
+        with self.measure(sip_name, "pii") as metrics:
+            metrics["exit_code"], metrics["max_rss_kb"] = self.run_tool(cmd, stop)
+
+    def process_sip(self, source):
+        """Create SIP once its data fits in the pending bytes budget."""
+        size = self.sizes.get(source, (0, 0))[1]
+        self.budget.acquire(size)
+        try:
+            return self.create_sip(
+                source, self.destination, self.bag_files, self.scan_for_pii
+            )
+        finally:
+            self.budget.release(size)
+
+    def stage(self, name):
+        """Return context manager that enforces the named stage's limit."""
+        return self.stage_semaphores.get(name, contextlib.nullcontext())
+
+    def device(self, source):
+        """Return context manager that limits readers of source's device.
+
+        With device_readers None, spinning disks allow DEVICE_READERS
+        readers, and solid state devices and network shares are not limited.
+        A device_readers of 0 turns the limit off.
+        """
+        device = source_device(source)
+        with self.device_lock:
+            if device not in self.device_semaphores:
+                limit = self.device_limit(device)
+                semaphore = contextlib.nullcontext()
+                if limit:
+                    semaphore = threading.BoundedSemaphore(limit)
+                self.device_semaphores[device] = semaphore
+            return self.device_semaphores[device]
+
+    def device_limit(self, device):
+        """Return number of readers allowed on device, or None for no limit."""
+        limit = self.device_readers
+        if limit is None and device is not None and is_rotational(device):
+            limit = DEVICE_READERS
+        return limit or None
+
+    def shards(self, source):
+        """Return number of threads to split work on source's files between.
+
+        Sources of more than SHARD_BYTES are split between up to workers
+        threads, so that a single large folder is not handled by one thread.
+        """
+        size = self.sizes.get(source, (0, 0))[1]
+        return max(1, min(self.workers, math.ceil(size / SHARD_BYTES)))
+
+    def copy_workers(self, source):
+        """Return number of threads to copy source with.
+
+        As shards, but no more than source's device allows readers, since
+        parallel reads would only make a spinning disk seek.
+        """
+        workers = self.shards(source)
+        limit = self.device_limit(source_device(source))
+        if limit:
+            workers = min(workers, limit)
+        return workers
+
+    @contextlib.contextmanager
+    def measure(self, sip_name, name, source=None):
+        """Run the named stage within its limit and log metrics for it.
+
+        If source is given, the stage also waits for a reader slot on the
+        source's device. Yields a dict to which the stage adds "files",
+        "bytes", "exit_code" and "max_rss_kb" where it knows them.
+        """
+        queued = time.monotonic()
+        device = contextlib.nullcontext() if source is None else self.device(source)
+        # Take the device slot first, so that a SIP waiting for its device
+        # does not hold a stage slot that a SIP from another device could use.
+        with device, self.stage(name):
+            metrics = {"sip": sip_name, "stage": name, "started": iso8601(time.time())}
+            start = time.monotonic()
+            event = {"event": "stage", "sip": sip_name, "stage": name}
+            self.report(dict(event, state="started"))
+            try:
+                yield metrics
+            except CommandError as err:
+                metrics["exit_code"] = err.exit_code
+                metrics["max_rss_kb"] = err.max_rss_kb
+                raise
+            finally:
+                seconds = time.monotonic() - start
+                metrics["seconds"] = round(seconds, 3)
+                metrics["wait_seconds"] = round(start - queued, 3)
+                metrics["mb_per_s"] = throughput(metrics.get("bytes"), seconds)
+                self.metrics.add(metrics)
+                self.report(dict(event, state="finished"))
+
+    def create_sip(self, source, destination, bag_files, scan_for_pii):
+        """Create SIP from source directory.
+
+        Stages already completed for this SIP according to the job journal
+        are skipped, so an interrupted batch can be run again to finish it.
+        A SIP cancelled part way through is quarantined instead.
+        Return list of FileRecords for the SIP's objects (None if no stage
+        needed them), or 1 on failure.
+        """
+        stop = threading.Event()
+        with self.stops_lock:
+            if self.cancelled.is_set():
+                return 1
+            self.stops.add(stop)
+        basename = os.path.basename(os.path.abspath(source))
+        try:
+            return self._create_sip(source, destination, bag_files, scan_for_pii, stop)
+        except Cancelled:
+            self.quarantine(basename)
+            return 1
+        except Exception as err:
+            if self.cancelled.is_set():
+                self.quarantine(basename)
+            else:
+                self.fail(
+                    basename, "Error creating SIP from {}: {}".format(source, err)
+                )
+            return 1
+        finally:
+            with self.stops_lock:
+                self.stops.discard(stop)
+
+    def fail(self, sip_name, message):
+        """Report that SIP could not be created and record it in the journal."""
+        self.journal.fail(sip_name, message)
+        self.report({"event": "error", "sip": sip_name, "message": message})
+
+    def _create_sip(self, source, destination, bag_files, scan_for_pii, stop):
+        basename = os.path.basename(os.path.abspath(source))
+        sip_dir = os.path.join(destination, basename)
+        object_dir = os.path.join(sip_dir, "objects")
+        original_dir = os.path.join(object_dir, basename)
+        metadata_dir = os.path.join(sip_dir, "metadata")
+        subdoc_dir = os.path.join(metadata_dir, "submissionDocumentation")
+        journal = self.journal
+
+        algorithms = HASH_ALGORITHMS
+        if bag_files:
+            algorithms += tuple(a for a in BAG_ALGORITHMS if a not in algorithms)
+        records = None
+        # Records from this run's copy, whose digests are of the source.
+        copy_records = None
+
+        def scan_objects():
+            # Objects may already have been moved into data/ by make_bag.
+            objects_path = original_dir
+            if not os.path.isdir(objects_path):
+                objects_path = os.path.join(sip_dir, "data", "objects", basename)
+            return scan_tree(objects_path, basename, algorithms=algorithms, stop=stop)
+
+        if not journal.done(basename, "copy"):
+            exists = os.path.lexists(sip_dir)
+            if not journal.begin(basename, os.path.abspath(source), exists):
+                self.report(
+                    {
+                        "event": "error",
+                        "sip": basename,
+                        "message": "{} already exists and was not started from {} "
+                        "by this job".format(sip_dir, source),
+                    }
+                )
+                return 1
+            # Remove partial SIP left behind by an interrupted run of this job.
+            if os.path.isdir(sip_dir):
+                shutil.rmtree(sip_dir)
+
+            for newfolder in sip_dir, object_dir, metadata_dir, subdoc_dir:
+                os.makedirs(newfolder)
+
+            # Copy files, recording their metadata and digests as they are read.
+            try:
+                with self.measure(basename, "copy", source) as metrics:
+                    records = copy_tree(
+                        source,
+                        original_dir,
+                        basename,
+                        algorithms,
+                        self.cache,
+                        self.advance_progress,
+                        stop,
+                        self.copy_workers(source),
+                    )
+                    metrics["files"], metrics["bytes"] = record_totals(records)
+            except shutil.Error as err:
+                self.fail(
+                    basename,
+                    "Error copying files from {} to {}: {}".format(
+                        source, original_dir, err
+                    ),
+                )
+                return 1
+            copy_records = records
+            journal.record(basename, "copy")
+        else:
+            self.advance_progress(*self.sizes.get(source, (0, 0)))
+
+        # Scan for PII with bulk_extractor while the SIP's other stages run.
+        # Setting stop kills the scan, and a failed scan sets stop to kill
+        # the tool running in the SIP's other stages.
+        pii = None
+
+        def stop_on_failure(future):
+            if future.exception() is not None:
+                stop.set()
+
+        pii_dir = os.path.join(subdoc_dir, "bulk_extractor.partial")
+        if scan_for_pii and not journal.done(basename, "pii"):
+            if self.cancelled.is_set():
+                raise Cancelled()
+            objects_path = original_dir
+            if not os.path.isdir(objects_path):
+                objects_path = os.path.join(sip_dir, "data", "objects", basename)
+            pii_executor = concurrent.futures.ThreadPoolExecutor(1)
+            pii = pii_executor.submit(
+                self.scan_pii, basename, os.path.abspath(objects_path), pii_dir, stop
+            )
+            pii.add_done_callback(stop_on_failure)
+            pii_executor.shutdown(wait=False)
+
+        def finish_pii():
+            # Wait for the PII scan and move its output into the Brunnhilde
+            # report, where Brunnhilde itself would have put it.
+            nonlocal pii
+            if pii is None:
+                return
+            try:
+                pii.result()
+            finally:
+                pii = None
+            bulk_extractor_dir = os.path.join(
+                subdoc_dir, "brunnhilde", "bulk_extractor"
+            )
+            if os.path.isdir(bulk_extractor_dir):
+                shutil.rmtree(bulk_extractor_dir)
+            os.makedirs(os.path.dirname(bulk_extractor_dir), exist_ok=True)
+            if os.path.isdir(pii_dir):
+                os.replace(pii_dir, bulk_extractor_dir)
+            journal.record(basename, "pii")
+
+        def check_stop():
+            # Raise the PII scan's CommandError as soon as it has failed.
+            if pii is not None and pii.done():
+                pii.result()
+            if self.cancelled.is_set():
+                raise Cancelled()
+
+        try:
+            # Run Brunnhilde and write results to submissionDocumentation.
+            if not journal.done(basename, "characterize"):
+                objects_abspath = os.path.abspath(object_dir)
+                brunnhilde_cmd = [
+                    "brunnhilde.py",
+                    "-zw",
+                    objects_abspath,
+                    subdoc_dir,
+                    "brunnhilde",
+                ]
+                check_stop()
+                brunnhilde_dir = os.path.join(subdoc_dir, "brunnhilde")
+                if os.path.isdir(brunnhilde_dir):
+                    shutil.rmtree(brunnhilde_dir)
+                sf_csv = os.path.join(brunnhilde_dir, "siegfried.csv")
+                with self.measure(basename, "characterize") as metrics:
+                    if records is not None:
+                        metrics["files"], metrics["bytes"] = record_totals(records)
+                    sf_input = self.identify(
+                        basename, object_dir, source, records, stop
+                    )
+                    if sf_input is not None:
+                        brunnhilde_cmd[1:1] = ["--csv", sf_input]
+                    try:
+                        metrics["exit_code"], metrics["max_rss_kb"] = self.run_tool(
+                            brunnhilde_cmd, stop
+                        )
+                    finally:
+                        # Keep the Siegfried CSV in the report like Brunnhilde does.
+                        if sf_input is not None and os.path.isdir(brunnhilde_dir):
+                            if not os.path.exists(sf_csv):
+                                shutil.move(sf_input, sf_csv)
+                        if sf_input is not None and os.path.exists(sf_input):
+                            os.remove(sf_input)
+                if self.cache is not None and os.path.isfile(sf_csv):
+                    cache_siegfried_rows(self.cache, sf_csv, object_dir, source)
+                journal.record(basename, "characterize")
+
+            # Write DFXML to submissionDocumentation from copy-time records.
+            if not journal.done(basename, "dfxml"):
+                dfxml_path = os.path.join(subdoc_dir, "dfxml.xml")
+                check_stop()
+                with self.measure(basename, "dfxml") as metrics:
+                    if records is None:
+                        records = scan_objects()
+                    records = write_dfxml(records, dfxml_path)
+                    metrics["files"], metrics["bytes"] = record_totals(records)
+                journal.record(basename, "dfxml")
+
+            # Bags include the PII report in their manifests, and bagging moves
+            # the objects being scanned.
+            if bag_files:
+                finish_pii()
+
+            # Bag files or write checksum manifest.
+            if not journal.done(basename, "checksum"):
+                check_stop()
+                with self.measure(basename, "checksum") as metrics:
+                    if records is None:
+                        records = list(scan_objects())
+                    metrics["files"], metrics["bytes"] = record_totals(records)
+                    if bag_files:
+                        make_bag(sip_dir, records)
+                    else:
+                        write_checksum_manifest(
+                            records, os.path.join(metadata_dir, "checksum.md5")
+                        )
+                journal.record(basename, "checksum")
+
+            finish_pii()
+
+            # Check objects against the source and the manifest.
+            if self.verify and not journal.done(basename, "verify"):
+                check_stop()
+                with self.measure(basename, "verify") as metrics:
+                    problems = self.verify_sip(
+                        source, sip_dir, basename, bag_files, copy_records, stop
+                    )
+                    if records is not None:
+                        metrics["files"], metrics["bytes"] = record_totals(records)
+                    metrics["problems"] = len(problems)
+                if problems:
+                    self.report(
+                        {
+                            "event": "warning",
+                            "message": "Fixity check found {} problem(s) in {}; "
+                            "see {}".format(
+                                len(problems),
+                                basename,
+                                self.fixity_report_path(basename),
+                            ),
+                        }
+                    )
+                journal.record(basename, "verify")
+
+            # Set file permissions. Objects were already set while copying.
+            if not journal.done(basename, "permissions"):
+                check_stop()
+                if bag_files:
+                    original_dir = os.path.join(sip_dir, "data", "objects", basename)
+                with self.measure(basename, "permissions") as metrics:
+                    metrics["files"] = set_permissions(sip_dir, skip=(original_dir,))
+                journal.record(basename, "permissions")
+
+            return records
+        except (CommandError, Cancelled) as err:
+            if self.cancelled.is_set():
+                raise Cancelled() from err
+            # Without a cancel, only a failed PII scan sets stop. Report its
+            # failure rather than the tool or stage it stopped.
+            if pii is not None and pii.done() and pii.exception() is not None:
+                err = pii.exception()
+            self.fail(basename, str(err))
+            return 1
+        finally:
+            # Do not leave a scan running if the SIP stopped early.
+            if pii is not None:
+                stop.set()
+                concurrent.futures.wait([pii])
+
+    def fixity_report_path(self, sip_name):
+        """Return path of SIP's fixity report in the output directory."""
+        return os.path.join(self.output_dir, FIXITY_DIRNAME, sip_name + ".csv")
+
+    def source_digests(self, source, relpath, algorithm, records=None, stop=None):
+        """Return dict of digests of source's files, keyed by object path.
+
+        Copy-time digests in records were computed from the source as it was
+        read, so they are used as they are. Without records, digests come
+        from the cache where it has them, and only the other files are read.
+        If the stop event is set, Cancelled is raised before the next file.
+        """
+        if records is not None:
+            return {
+                record.path: getattr(record, algorithm)
+                for record in records
+                if record.name_type == "r"
+            }
+        digests = {}
+        to_hash = []
+        source = os.path.abspath(source)
+        for dirpath, dirnames, filenames in os.walk(source, followlinks=True):
+            if stop is not None and stop.is_set():
+                raise Cancelled()
+            rel_dir = os.path.relpath(dirpath, source).replace(os.sep, "/")
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                rel = "/".join(
+                    part for part in (relpath, rel_dir, filename) if part != "."
+                )
+                cached = None
+                if self.cache is not None:
+                    try:
+                        cached = self.cache.get_digests(
+                            path, os.stat(path), (algorithm,)
+                        )
+                    except OSError:
+                        pass
+                if cached:
+                    digests[rel] = cached[algorithm]
+                else:
+                    to_hash.append((rel, path))
+
+        def _hash(item):
+            if stop is not None and stop.is_set():
+                raise Cancelled()
+            rel, path = item
+            return rel, hash_file(path, (algorithm,))[algorithm]
+
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            digests.update(executor.map(_hash, to_hash))
+        return digests
+
+    def verify_sip(self, source, sip_dir, sip_name, bag_files, records=None, stop=None):
+        """Verify SIP's objects and write its fixity report.
+
+        Objects are compared with the source's digests (see source_digests)
+        and with the SIP's checksum.md5 or bag SHA-256 manifest. Return the
+        list of problems found by verify_objects.
+        """
+        if bag_files:
+            objects_dir = os.path.join(sip_dir, "data", "objects")
+            algorithm = "sha256"
+            manifest = read_manifest(
+                os.path.join(sip_dir, "manifest-sha256.txt"),
+                "data/objects",
+                escaped=True,
+            )
+        else:
+            objects_dir = os.path.join(sip_dir, "objects")
+            algorithm = "md5"
+            manifest = read_manifest(
+                os.path.join(sip_dir, "metadata", "checksum.md5"), "../objects"
+            )
+        expected = self.source_digests(source, sip_name, algorithm, records, stop)
+        problems = verify_objects(
+            expected, manifest, objects_dir, algorithm, self.workers, stop
+        )
+        write_fixity_report(problems, self.fixity_report_path(sip_name))
+        return problems
+
+    def run(self):
+        """Process directories through the create_sip stages as a pipeline.
+
+        Up to workers SIPs are in each stage at once (less where
+        STAGE_LIMITS sets a lower limit), and up to workers * pipeline_depth
+        SIPs are in progress, so that one SIP can be copied while another is
+        characterized. A SIP only starts once the bytes of SIPs in progress
+        plus its own fit in max_pending_bytes (by default half the free space
+        at the destination). Sources are started alternating between the
+        devices they are on, and copies from each device are limited as
+        described in device.
+
+        Return the number of SIPs that could not be created, not counting
+        those cancelled.
+        """
+        description = DescriptionWriter(
+            os.path.join(self.output_dir, "description.csv"), self.bag_files
+        )
+        # Keep rows of SIPs described by earlier runs of this job.
+        description.rows.update(self.journal.rows())
+        description.summaries.update(self.journal.summaries())
+        if description.rows:
+            description.write()
+
+        failed = 0
+        cancelled = 0
+        dirs_to_process = []
+        for dir_to_process in interleave_by_device(self.dirs_to_process):
+            source = os.path.abspath(dir_to_process)
+            basename = os.path.basename(source)
+            if self.journal.done(basename, "describe"):
+                status = "skipped"
+                if self.journal.source(basename) != source:
+                    # Another folder of the same name already made this SIP.
+                    failed += 1
+                    status = "failed"
+                    self.report(
+                        {
+                            "event": "error",
+                            "sip": basename,
+                            "message": "{} already holds a SIP created from {}".format(
+                                os.path.join(self.destination, basename),
+                                self.journal.source(basename),
+                            ),
+                        }
+                    )
+                self.report(
+                    {
+                        "event": "sip_done",
+                        "source": dir_to_process,
+                        "sip": basename,
+                        "status": status,
+                    }
+                )
+            else:
+                dirs_to_process.append(dir_to_process)
+
+        # Size sources up front, for progress reporting and space checks.
+        self.sizes = preflight(dirs_to_process)
+        files_total = sum(files for files, size in self.sizes.values())
+        bytes_total = sum(size for files, size in self.sizes.values())
+        free_bytes = free_space(self.destination)
+        self.report(
+            {
+                "event": "preflight",
+                "files": files_total,
+                "bytes": bytes_total,
+                "free_bytes": free_bytes,
+            }
+        )
+        if bytes_total > free_bytes:
+            self.report(
+                {
+                    "event": "warning",
+                    "message": "Sources hold {} but only {} is free at {}".format(
+                        convert_size(bytes_total),
+                        convert_size(free_bytes),
+                        self.destination,
+                    ),
+                }
+            )
+        self.progress = Progress(files_total, bytes_total)
+        if self.max_pending_bytes is None:
+            self.budget = ByteBudget(free_bytes // 2)
+
+        # The cache is closed at the end of each run, so reopen it for another.
+        if self.cache is None and self.cache_path:
+            self.cache = DigestCache(self.cache_path)
+
+        # Share one Siegfried server, and its loaded signatures, between SIPs.
+        if self.shared_siegfried and dirs_to_process:
+            self.siegfried = SiegfriedServer.start()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                self.workers * self.pipeline_depth
+            ) as executor:
+                futures = {
+                    executor.submit(self.process_sip, dir_to_process): dir_to_process
+                    for dir_to_process in dirs_to_process
+                }
+                for future in concurrent.futures.as_completed(futures):
+                    dir_to_process = futures[future]
+                    basename = os.path.basename(os.path.abspath(dir_to_process))
+                    records = future.result()
+                    event = {
+                        "event": "sip_done",
+                        "source": dir_to_process,
+                        "sip": basename,
+                        "status": "failed",
+                    }
+                    if records == 1 and self.cancelled.is_set():
+                        cancelled += 1
+                        event["status"] = "cancelled"
+                        if basename in self.incomplete:
+                            event["incomplete"] = self.incomplete[basename]
+                    elif records == 1:
+                        failed += 1
+                    else:
+                        try:
+                            fixity = None
+                            if self.verify:
+                                fixity = read_fixity_report(
+                                    self.fixity_report_path(basename)
+                                )
+                            row = description.add(
+                                os.path.join(self.destination, basename),
+                                records,
+                                fixity,
+                                os.path.join(FIXITY_DIRNAME, basename + ".csv"),
+                            )
+                        except Exception as err:
+                            failed += 1
+                            self.fail(
+                                basename,
+                                "Error describing {}: {}".format(basename, err),
+                            )
+                        else:
+                            self.journal.record(
+                                basename,
+                                "describe",
+                                row=row,
+                                summary=description.summaries[basename],
+                            )
+                            event["status"] = "ok"
+                    self.report(event)
+
+            if self.cache is not None:
+                self.cache.commit()
+                self.cache.evict(self.cache_max_age_days, self.cache_max_entries)
+        finally:
+            if self.siegfried is not None:
+                self.siegfried.close()
+                self.siegfried = None
+            if self.cache is not None:
+                self.cache.close()
+                self.cache = None
+
+        self.report(
+            {
+                "event": "done",
+                "total": len(self.dirs_to_process),
+                "failed": failed,
+                "cancelled": cancelled,
+                "stages": self.metrics.summary(),
+            }
+        )
+        return failed
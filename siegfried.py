@@ -0,0 +1,189 @@
+"""
+CCA Folder Processor - shared Siegfried server
+
+Runs one long-lived "sf -serve" process for a batch, so that the signature
+file is loaded once rather than by every Brunnhilde run.
+
+(c) Canadian Centre for Architecture
+MIT License
+"""
+import base64
+import concurrent.futures
+import os
+import socket
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# Seconds to wait for the server to accept connections.
+START_TIMEOUT = 30
+
+# Seconds between checks of the stop event while waiting for a response.
+POLL_INTERVAL = 0.5
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def split_tree(path, pieces):
+    """Return list of paths that together hold the files under path.
+
+    Directories are replaced by their contents, one level at a time, until
+    there are at least pieces paths or no directories are left.
+    """
+    paths = [path]
+    while len(paths) < pieces:
+        expanded = []
+        for item in paths:
+            try:
+                names = sorted(os.listdir(item)) if os.path.isdir(item) else None
+            except OSError:
+                names = None
+            if names is None:
+                expanded.append(item)
+            else:
+                expanded.extend(os.path.join(item, name) for name in names)
+        if expanded == paths:
+            break
+        paths = expanded
+    return paths
+
+
+class SiegfriedServer(object):
+    """Siegfried identification server running in a child process.
+
+    identify returns CSV in the same format as "sf -csv", which Brunnhilde
+    accepts with its --csv option.
+    """
+
+    def __init__(self, host="localhost", port=None, sf="sf"):
+        port = port or _free_port()
+        self.address = "{}:{}".format(host, port)
+        self.process = subprocess.Popen(
+            [sf, "-serve", self.address],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + START_TIMEOUT
+        while True:
+            if self.process.poll() is not None:
+                raise OSError(
+                    "sf -serve exited with code {}".format(self.process.returncode)
+                )
+            try:
+                with socket.create_connection((host, port), 1):
+                    break
+            except OSError:
+                if time.monotonic() > deadline:
+                    self.close()
+                    raise
+                time.sleep(0.1)
+
+    @classmethod
+    def start(cls):
+        """Return a running server, or None if Siegfried is unavailable."""
+        try:
+            return cls()
+        except OSError:
+            return None
+
+    def identify(
+        self, path, scan_archives=True, hash_type="md5", timeout=None, stop=None
+    ):
+        """Identify file or directory tree at path and return CSV text.
+
+        Raise OSError if the request fails, takes longer than timeout
+        seconds, or the stop event is set. The server may go on identifying
+        an abandoned tree until it is closed.
+        """
+        encoded = base64.urlsafe_b64encode(path.encode("utf-8")).decode("ascii")
+        query = {"base64": "true", "format": "csv", "z": str(scan_archives).lower()}
+        if hash_type:
+            query["hash"] = hash_type
+        url = "http://{}/identify/{}?{}".format(
+            self.address, encoded, urllib.parse.urlencode(query)
+        )
+        # Wait for the response in a daemon thread, so that waiting can be
+        # given up on without leaving the caller blocked on the socket.
+        result = concurrent.futures.Future()
+
+        def _request():
+            try:
+                with urllib.request.urlopen(url, timeout=timeout) as response:
+                    result.set_result(response.read().decode("utf-8"))
+            except Exception as err:
+                result.set_exception(err)
+
+        threading.Thread(target=_request, daemon=True).start()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not concurrent.futures.wait([result], POLL_INTERVAL).done:
+            if stop is not None and stop.is_set():
+                raise OSError(
+                    "Siegfried server request for {} was stopped".format(path)
+                )
+            if deadline is not None and time.monotonic() > deadline:
+                raise OSError(
+                    "Siegfried server timed out after {} seconds identifying {}".format(
+                        timeout, path
+                    )
+                )
+        try:
+            return result.result()
+        except OSError as err:
+            raise OSError(
+                "Siegfried server could not identify {}: {}".format(path, err)
+            )
+
+    def identify_tree(self, path, workers=1, **kwargs):
+        """Identify directory tree at path with up to workers requests at once.
+
+        With more than one worker, the tree is split with split_tree and
+        identified as by identify_paths. Keyword arguments are passed to
+        identify.
+        """
+        if workers <= 1:
+            return self.identify(path, **kwargs)
+        return self.identify_paths(split_tree(path, workers), workers, **kwargs)
+
+    def identify_paths(self, paths, workers=1, **kwargs):
+        """Identify files or trees at paths with up to workers requests at once.
+
+        The CSV of each path is merged under a single header. Keyword
+        arguments are passed to identify.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as executor:
+            texts = list(
+                executor.map(lambda piece: self.identify(piece, **kwargs), paths)
+            )
+        header = ""
+        rows = []
+        for text in texts:
+            # Only the header is split off; rows may contain quoted newlines.
+            first, _, rest = text.partition("\n")
+            header = header or first + "\n"
+            if rest and not rest.endswith("\n"):
+                rest += "\n"
+            rows.append(rest)
+        return header + "".join(rows)
+
+    def close(self):
+        """Stop the server."""
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -20,6 +20,10 @@ sudo mkdir /usr/share/ccatools/folderprocessor
 
 # Move files into /usr/share/ccatools/folderprocessor
 sudo cp main.py /usr/share/ccatools/folderprocessor
+sudo cp processor.py /usr/share/ccatools/folderprocessor
+sudo cp cache.py /usr/share/ccatools/folderprocessor
+sudo cp siegfried.py /usr/share/ccatools/folderprocessor
+sudo cp cli.py /usr/share/ccatools/folderprocessor
 sudo cp launch /usr/share/ccatools/folderprocessor
 sudo cp design.py /usr/share/ccatools/folderprocessor
 sudo cp design.ui /usr/share/ccatools/folderprocessor
@@ -28,8 +32,6 @@ sudo cp LICENSE /usr/share/ccatools/folderprocessor
 sudo cp README.md /usr/share/ccatools/folderprocessor
 sudo cp deps/dfxml/python/dfxml.py /usr/share/ccatools/folderprocessor
 sudo cp deps/dfxml/python/Objects.py /usr/share/ccatools/folderprocessor
-sudo cp deps/dfxml/python/walk_to_dfxml.py /usr/share/ccatools/folderprocessor
 
 sudo cp deps/dfxml/python/dfxml.py .
 sudo cp deps/dfxml/python/Objects.py .
-sudo cp deps/dfxml/python/walk_to_dfxml.py .
@@ -1,15 +1,59 @@
+import csv
+import errno
+import hashlib
+import json
 import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
 
 import bagit
 import pytest
 
-from main import SIPThread
+import benchmark
+import cli
+import processor
+import siegfried
+from cache import DigestCache
+from main import CheckableDirModel, ProcessorApp, SIPThread
+from processor import (
+	CSV_HEADERS,
+	DescriptionWriter,
+	SIPProcessor,
+	build_csv_row,
+	copy_tree,
+	make_bag,
+	scan_tree,
+	set_permissions,
+	write_dfxml,
+)
 
 
 def is_non_zero_file(filepath):
 	return os.path.isfile(filepath) and os.path.getsize(filepath) > 0
 
 
+def fake_brunnhilde(count=1, before=None):
+	"""Return fake run_command that writes a Brunnhilde formats.csv.
+
+	The report counts count plain text files. before, if given, is called
+	with the command first.
+	"""
+	def run_command(cmd, timeout=None, stop=None):
+		if before is not None:
+			before(cmd)
+		csv_dir = os.path.join(cmd[-2], "brunnhilde", "csv_reports")
+		os.makedirs(csv_dir)
+		with open(os.path.join(csv_dir, "formats.csv"), "w") as f:
+			f.write("Format,ID,Count\nPlain Text File,x-fmt/111,{}\n".format(count))
+		return 0, 1024
+
+	return run_command
+
+
 def test_create_sip(tmp_path):
 	OUTPUT_DIR = str(tmp_path / "output")
 	DEST_DIR = str(tmp_path / "dest")
@@ -102,3 +146,1059 @@ def test_bulk_extractor(tmp_path):
 	assert is_non_zero_file(os.path.join(OBJECT_FILES_DIR, "test.txt"))
 
 	assert is_non_zero_file(os.path.join(BRUNNHILDE_BE_DIR, "report.xml"))
+
+
+def test_bulk_extractor_bagged(tmp_path):
+	OUTPUT_DIR = str(tmp_path / "output")
+	DEST_DIR = str(tmp_path / "dest")
+
+	for dir_ in (OUTPUT_DIR, DEST_DIR):
+		os.makedirs(dir_)
+
+	sip_thread = SIPThread(
+		dirs_to_process=[os.path.abspath("./requirements")],
+		destination=DEST_DIR,
+		bag_files=True,
+		scan_for_pii=True,
+		output_dir=OUTPUT_DIR
+	)
+	sip_thread.run()
+
+	SIP_DIR = os.path.join(DEST_DIR, "requirements")
+	BRUNNHILDE_BE_DIR = os.path.join(
+		SIP_DIR, "data", "metadata", "submissionDocumentation", "brunnhilde", "bulk_extractor"
+	)
+
+	assert is_non_zero_file(os.path.join(BRUNNHILDE_BE_DIR, "report.xml"))
+	assert bagit.Bag(SIP_DIR).validate()
+	with open(os.path.join(SIP_DIR, "manifest-sha256.txt")) as f:
+		assert "bulk_extractor/report.xml" in f.read()
+
+
+def _write_fake_sip(sips_dir, name, mtime):
+	subdoc_dir = os.path.join(sips_dir, name, "metadata", "submissionDocumentation")
+	csv_dir = os.path.join(subdoc_dir, "brunnhilde", "csv_reports")
+	os.makedirs(csv_dir)
+	with open(os.path.join(subdoc_dir, "dfxml.xml"), "w") as f:
+		f.write(
+			'<?xml version="1.0"?>\n<dfxml version="1.1.1">'
+			"<fileobject><filename>{0}/a.txt</filename><name_type>r</name_type>"
+			"<filesize>10</filesize><mtime>{1}</mtime></fileobject>"
+			"</dfxml>".format(name, mtime)
+		)
+	with open(os.path.join(csv_dir, "formats.csv"), "w") as f:
+		f.write("Format,ID,Count\nPlain Text File,x-fmt/111,1\n")
+	return os.path.join(sips_dir, name)
+
+
+def test_description_writer(tmp_path):
+	csv_path = str(tmp_path / "description.csv")
+	sips_dir = str(tmp_path / "SIPs")
+
+	writer = DescriptionWriter(csv_path, bag_files=False)
+	writer.add(_write_fake_sip(sips_dir, "b", "2019-01-01T00:00:00Z"))
+	writer.add(_write_fake_sip(sips_dir, "a", "2018-01-01T00:00:00Z"))
+
+	with open(csv_path) as f:
+		rows = list(csv.reader(f))
+	assert rows[0] == CSV_HEADERS
+	assert [row[1] for row in rows[1:]] == ["a", "b"]
+	assert rows[1][4] == "2018"
+	assert rows[2][8] == "1 digital file (10 bytes)"
+	assert not os.path.exists(csv_path + ".tmp")
+
+	with open(str(tmp_path / "summary.jsonl")) as f:
+		summaries = [json.loads(line) for line in f]
+	assert [summary["sip"] for summary in summaries] == ["a", "b"]
+	assert summaries[0]["file_count"] == 1
+	assert summaries[0]["total_bytes"] == 10
+	assert summaries[0]["earliest_mtime"] == "2018-01-01T00:00:00Z"
+	assert summaries[0]["formats"] == [
+		{"format": "Plain Text File", "puid": "x-fmt/111", "count": 1}
+	]
+	assert summaries[0]["checksum_manifests"] == ["metadata/checksum.md5"]
+
+
+def test_parallel_description_order(tmp_path, mocker):
+	OUTPUT_DIR = str(tmp_path / "output")
+	DEST_DIR = str(tmp_path / "dest")
+	names = ["d", "c", "b", "a"]
+
+	def fake_create_sip(source, destination, bag_files, scan_for_pii):
+		# Finish in reverse order of submission.
+		time.sleep(0.05 * (len(names) - names.index(os.path.basename(source))))
+		_write_fake_sip(destination, os.path.basename(source), "2018-01-01T00:00:00Z")
+
+	os.makedirs(OUTPUT_DIR)
+	sip_processor = SIPProcessor(
+		dirs_to_process=[str(tmp_path / "src" / name) for name in names],
+		destination=DEST_DIR,
+		bag_files=False,
+		scan_for_pii=False,
+		output_dir=OUTPUT_DIR,
+		workers=4,
+	)
+	mocker.patch.object(sip_processor, "create_sip", side_effect=fake_create_sip)
+	sip_processor.run()
+
+	with open(os.path.join(OUTPUT_DIR, "description.csv")) as f:
+		rows = list(csv.reader(f))
+	assert [row[1] for row in rows[1:]] == ["a", "b", "c", "d"]
+
+
+def test_copy_tree_records_digests(tmp_path):
+	source = tmp_path / "src"
+	(source / "sub").mkdir(parents=True)
+	(source / "sub" / "a.txt").write_bytes(b"hello")
+	os.utime(str(source / "sub" / "a.txt"), (946684800, 946684800))
+
+	records = copy_tree(str(source), str(tmp_path / "dst"), "src")
+
+	files = {record.path: record for record in records if record.name_type == "r"}
+	assert list(files) == ["src/sub/a.txt"]
+	assert files["src/sub/a.txt"].md5 == hashlib.md5(b"hello").hexdigest()
+	assert files["src/sub/a.txt"].sha256 == hashlib.sha256(b"hello").hexdigest()
+	assert files["src/sub/a.txt"].mtime == "2000-01-01T00:00:00Z"
+	assert (tmp_path / "dst" / "sub" / "a.txt").read_bytes() == b"hello"
+	assert os.stat(str(tmp_path / "dst" / "sub" / "a.txt")).st_mtime == 946684800
+
+
+def test_copy_tree_rejects_special_files(tmp_path):
+	source = tmp_path / "src"
+	source.mkdir()
+	(source / "a.txt").write_bytes(b"hello")
+	os.mkfifo(str(source / "pipe"))
+
+	with pytest.raises(shutil.Error) as excinfo:
+		copy_tree(str(source), str(tmp_path / "copy"), "src")
+
+	[(src, dst, message)] = excinfo.value.args[0]
+	assert src == str(source / "pipe")
+	assert "is a named pipe" in message
+	assert (tmp_path / "copy" / "a.txt").read_bytes() == b"hello"
+	assert not (tmp_path / "copy" / "pipe").exists()
+
+
+def test_copy_tree_shards(tmp_path, mocker):
+	source = tmp_path / "src"
+	for i in range(3):
+		(source / "sub{}".format(i)).mkdir(parents=True)
+		for j in range(5):
+			(source / "sub{}".format(i) / "f{}.txt".format(j)).write_bytes(b"x" * (i + j))
+	mocker.patch("processor.SHARD_FILES", 2)
+
+	sequential = copy_tree(str(source), str(tmp_path / "one"), "src")
+	sharded = copy_tree(str(source), str(tmp_path / "four"), "src", workers=4)
+
+	assert [(r.path, r.name_type, r.size, r.md5) for r in sharded] == [
+		(r.path, r.name_type, r.size, r.md5) for r in sequential
+	]
+	assert len([r for r in sharded if r.name_type == "r"]) == 15
+	assert (tmp_path / "four" / "sub2" / "f4.txt").read_bytes() == b"x" * 6
+	assert os.stat(str(tmp_path / "four" / "sub1")).st_mtime == os.stat(
+		str(source / "sub1")
+	).st_mtime
+
+
+def test_identify_tree(tmp_path, mocker):
+	(tmp_path / "objects" / "src" / "a").mkdir(parents=True)
+	(tmp_path / "objects" / "src" / "a" / "1.txt").write_text("1")
+	(tmp_path / "objects" / "src" / "2.txt").write_text("2")
+	objects = str(tmp_path / "objects")
+	assert siegfried.split_tree(objects, 2) == [
+		os.path.join(objects, "src", "2.txt"),
+		os.path.join(objects, "src", "a"),
+	]
+
+	def identify(path, **kwargs):
+		return "filename,id\n{},x-fmt/111\n".format(os.path.basename(path))
+
+	server = siegfried.SiegfriedServer.__new__(siegfried.SiegfriedServer)
+	mocker.patch.object(server, "identify", side_effect=identify)
+	text = server.identify_tree(objects, 2)
+	assert text == "filename,id\n2.txt,x-fmt/111\na,x-fmt/111\n"
+
+
+@pytest.mark.parametrize("zero_copy", [True, False, "copies nothing"])
+def test_copy_file(tmp_path, mocker, zero_copy):
+	source = tmp_path / "a.bin"
+	data = os.urandom(3 * 1024 * 1024 + 7)
+	source.write_bytes(data)
+	os.utime(str(source), ns=(946684800123456789, 946684800123456789))
+	if zero_copy is not True:
+		# Kernel copies either fail or, as on some FUSE mounts, return 0.
+		unsupported = OSError(errno.EXDEV, "Invalid cross-device link")
+		if zero_copy:
+			unsupported = None
+		mocker.patch("processor._reflink", return_value=False)
+		mocker.patch(
+			"processor.os.copy_file_range", side_effect=unsupported, return_value=0, create=True
+		)
+		mocker.patch("processor.os.sendfile", side_effect=unsupported, return_value=0, create=True)
+
+	for algorithms in (("md5",), ()):
+		destination = tmp_path / "copy-{}.bin".format(len(algorithms))
+		digests = processor.copy_file(
+			str(source), str(destination), algorithms, buffer_size=1024 * 1024
+		)
+
+		assert destination.read_bytes() == data
+		assert os.stat(str(destination)).st_mtime_ns == 946684800123456789
+		assert digests == {a: hashlib.new(a, data).hexdigest() for a in algorithms}
+
+
+def test_copy_file_reflink_skips_read_without_digests(tmp_path, mocker):
+	source = tmp_path / "a.bin"
+	source.write_bytes(b"hello")
+	mocker.patch("processor._reflink", return_value=True)
+	hash_stream = mocker.patch("processor._hash_stream")
+
+	assert processor.copy_file(str(source), str(tmp_path / "copy.bin"), ()) == {}
+	assert not hash_stream.called
+
+
+def test_kernel_copy_checks_size(tmp_path, mocker):
+	source = tmp_path / "a.bin"
+	source.write_bytes(b"0123456789")
+	mocker.patch("processor._reflink", return_value=False)
+	mocker.patch("processor.os.copy_file_range", side_effect=[5, 0], create=True)
+
+	with pytest.raises(OSError, match="Copied 5 of 10 bytes"):
+		processor.copy_file(str(source), str(tmp_path / "copy.bin"), ())
+
+
+def test_copy_tree_uses_cache(tmp_path, mocker):
+	source = tmp_path / "src"
+	source.mkdir()
+	(source / "a.txt").write_bytes(b"hello")
+	(source / "b.txt").write_bytes(b"world")
+	digest_cache = DigestCache(str(tmp_path / "cache.sqlite"))
+	copy_tree(str(source), str(tmp_path / "dst1"), "src", cache=digest_cache)
+	(source / "b.txt").write_bytes(b"changed")
+	os.utime(str(source / "b.txt"), (946684800, 946684800))
+	spy = mocker.spy(processor, "copy_file")
+
+	records = copy_tree(str(source), str(tmp_path / "dst2"), "src", cache=digest_cache)
+
+	hashed = [call[0][0] for call in spy.call_args_list if call[0][2]]
+	assert hashed == [str(source / "b.txt")]
+	files = {record.path: record for record in records if record.name_type == "r"}
+	assert files["src/a.txt"].md5 == hashlib.md5(b"hello").hexdigest()
+	assert files["src/b.txt"].md5 == hashlib.md5(b"changed").hexdigest()
+	assert (tmp_path / "dst2" / "a.txt").read_bytes() == b"hello"
+	assert digest_cache.evict(max_age_days=None, max_entries=1) == 1
+
+
+def test_write_dfxml_from_scan(tmp_path):
+	objects_dir = tmp_path / "sip" / "objects"
+	subdoc_dir = tmp_path / "sip" / "metadata" / "submissionDocumentation"
+	csv_dir = subdoc_dir / "brunnhilde" / "csv_reports"
+	(objects_dir / "src").mkdir(parents=True)
+	csv_dir.mkdir(parents=True)
+	(objects_dir / "src" / "a.txt").write_bytes(b"hello")
+	(objects_dir / "src" / "b.txt").write_bytes(b"world!")
+	(csv_dir / "formats.csv").write_text("Format,ID,Count\nPlain Text File,x-fmt/111,2\n")
+
+	records = write_dfxml(
+		scan_tree(str(objects_dir / "src"), "src", workers=2),
+		str(subdoc_dir / "dfxml.xml"),
+	)
+
+	# Files are listed in inode order, like copy_tree, then the directory.
+	files = sorted(("a.txt", "b.txt"), key=lambda name: os.stat(str(objects_dir / "src" / name)).st_ino)
+	assert [record.path for record in records] == ["src/" + name for name in files] + ["src"]
+	sip_path = str(tmp_path / "sip")
+	row = build_csv_row(sip_path, bag_files=False, records=records)
+	assert row == build_csv_row(sip_path, bag_files=False)
+	assert row[8] == "2 digital files (11 bytes)"
+
+
+def test_dfxml_file_stats(tmp_path):
+	dfxml_file = tmp_path / "dfxml.xml"
+	dfxml_file.write_text(
+		'<?xml version="1.0"?>\n'
+		'<dfxml xmlns="http://www.forensicswiki.org/wiki/Category:Digital_Forensics_XML">'
+		"<volume><fileobject><name_type>d</name_type><filesize>0</filesize></fileobject>"
+		"<fileobject><name_type>r</name_type><filesize>5</filesize>"
+		"<mtime>2001-01-01T00:00:00Z</mtime>"
+		"<parent_object><filesize>9</filesize></parent_object></fileobject>"
+		"<fileobject><filesize>6</filesize></fileobject></volume></dfxml>"
+	)
+
+	stats = list(processor.dfxml_file_stats(str(dfxml_file)))
+
+	assert stats == [
+		("d", "", 0),
+		("r", "2001-01-01T00:00:00Z", 5),
+		(None, "", 6),
+	]
+	sip_stats = processor.SIPStats()
+	for name_type, mtime, filesize in stats:
+		sip_stats.add(name_type, mtime, filesize)
+	assert (sip_stats.file_count, sip_stats.total_bytes) == (2, 11)
+	assert (sip_stats.earliest, sip_stats.latest) == ("", "2001-01-01T00:00:00Z")
+
+
+def test_read_fileobjects(tmp_path):
+	dfxml_file = tmp_path / "dfxml.xml"
+	dfxml_file.write_text(
+		'<?xml version="1.0"?>\n<dfxml><volume><fileobject>'
+		"<filename>src/a.txt</filename><name_type>r</name_type><filesize>5</filesize>"
+		'<hashdigest type="MD5">5d41402abc4b2a76b9719d911017c592</hashdigest>'
+		'<hashdigest type="sha256">2cf24dba</hashdigest>'
+		"</fileobject></volume></dfxml>"
+	)
+
+	(fileobject,) = processor.read_fileobjects(str(dfxml_file), ("filename", "md5", "filesize"))
+
+	assert fileobject.filename == "src/a.txt"
+	assert fileobject.md5 == "5d41402abc4b2a76b9719d911017c592"
+	assert fileobject.filesize == 5
+	assert fileobject.name_type is None
+	assert fileobject.sha256 is None
+	assert not hasattr(fileobject, "__dict__")
+	with pytest.raises(ValueError):
+		list(processor.read_fileobjects(str(dfxml_file), ("byte_runs",)))
+
+
+def test_make_bag_reuses_copy_digests(tmp_path, mocker):
+	source = tmp_path / "src"
+	source.mkdir()
+	(source / "a.txt").write_bytes(b"hello")
+	sip_dir = tmp_path / "sip"
+	(sip_dir / "metadata").mkdir(parents=True)
+	(sip_dir / "metadata" / "checksum.md5").write_text("x")
+	records = copy_tree(
+		str(source), str(sip_dir / "objects" / "src"), "src", processor.BAG_ALGORITHMS
+	)
+	spy = mocker.spy(processor, "hash_file")
+
+	bag = make_bag(str(sip_dir), records)
+
+	assert bag.validate()
+	hashed = [call[0][0] for call in spy.call_args_list]
+	assert not any(path.endswith("a.txt") for path in hashed)
+
+
+def test_set_permissions(tmp_path):
+	(tmp_path / "objects" / "src").mkdir(parents=True)
+	(tmp_path / "objects" / "src" / "a.txt").write_text("a")
+	(tmp_path / "metadata").mkdir(mode=0o700)
+	(tmp_path / "metadata" / "b.txt").write_text("b")
+	os.chmod(str(tmp_path / "metadata" / "b.txt"), 0o600)
+	os.chmod(str(tmp_path / "objects" / "src" / "a.txt"), 0o600)
+
+	set_permissions(str(tmp_path), skip=(str(tmp_path / "objects" / "src"),))
+
+	assert os.stat(str(tmp_path / "metadata")).st_mode & 0o777 == 0o755
+	assert os.stat(str(tmp_path / "metadata" / "b.txt")).st_mode & 0o777 == 0o644
+	assert os.stat(str(tmp_path / "objects")).st_mode & 0o777 == 0o755
+	assert os.stat(str(tmp_path / "objects" / "src" / "a.txt")).st_mode & 0o777 == 0o600
+
+
+def test_preflight(tmp_path):
+	(tmp_path / "a" / "sub" / "deeper").mkdir(parents=True)
+	(tmp_path / "a" / "top.txt").write_bytes(b"12")
+	(tmp_path / "a" / "sub" / "b.txt").write_bytes(b"123")
+	(tmp_path / "a" / "sub" / "deeper" / "c.txt").write_bytes(b"1234")
+	(tmp_path / "empty").mkdir()
+
+	sizes = processor.preflight([str(tmp_path / "a"), str(tmp_path / "empty")])
+
+	assert sizes == {str(tmp_path / "a"): (3, 9), str(tmp_path / "empty"): (0, 0)}
+
+
+def test_copy_tree_reads_files_in_inode_order(tmp_path):
+	source = tmp_path / "src"
+	(source / "sub").mkdir(parents=True)
+	for name in ("c.txt", "a.txt", "b.txt"):
+		(source / name).write_bytes(name.encode())
+
+	records = copy_tree(str(source), str(tmp_path / "dst"), "src")
+
+	by_inode = sorted(
+		(os.stat(str(source / name)).st_ino, name) for name in ("a.txt", "b.txt", "c.txt")
+	)
+	assert [record.path for record in records] == (
+		["src/" + name for _, name in by_inode] + ["src/sub", "src"]
+	)
+
+
+def test_device_scheduling(tmp_path, mocker):
+	# Sources are named after their device; "a" is a spinning disk.
+	mocker.patch("processor.source_device", side_effect=lambda path: path[0])
+	mocker.patch("processor.is_rotational", side_effect=lambda device: device == "a")
+
+	assert processor.interleave_by_device(["a1", "a2", "a3", "b1", "c1"]) == [
+		"a1",
+		"b1",
+		"c1",
+		"a2",
+		"a3",
+	]
+
+	sip_processor = SIPProcessor([], str(tmp_path), False, False, str(tmp_path))
+	disk = sip_processor.device("a1")
+	assert disk is sip_processor.device("a2")
+	assert disk.acquire(blocking=False)
+	assert not disk.acquire(blocking=False)
+	disk.release()
+	assert not hasattr(sip_processor.device("b1"), "acquire")
+
+	sip_processor = SIPProcessor(
+		[], str(tmp_path), False, False, str(tmp_path), device_readers=0
+	)
+	assert not hasattr(sip_processor.device("a1"), "acquire")
+
+
+def test_unknown_device_is_not_rotational():
+	# No such device in sysfs, as for network shares.
+	assert not processor.is_rotational(os.makedev(4095, 1048575))
+
+
+def test_resume_from_journal(tmp_path, mocker):
+	OUTPUT_DIR = str(tmp_path / "output")
+	DEST_DIR = str(tmp_path / "dest")
+	for dir_ in (OUTPUT_DIR, DEST_DIR):
+		os.makedirs(dir_)
+	source = tmp_path / "src"
+	source.mkdir()
+	(source / "a.txt").write_bytes(b"hello")
+
+	def make_processor():
+		return SIPProcessor(
+			dirs_to_process=[str(source)],
+			destination=DEST_DIR,
+			bag_files=False,
+			scan_for_pii=False,
+			output_dir=OUTPUT_DIR,
+		)
+
+	# First run stops after the copy stage.
+	sip_processor = make_processor()
+	mocker.patch(
+		"processor.run_command",
+		side_effect=processor.CommandError(["brunnhilde.py"], "exited with code 1", 1),
+	)
+	assert sip_processor.create_sip(str(source), DEST_DIR, False, False) == 1
+	assert sip_processor.journal.done("src", "copy")
+	assert not sip_processor.journal.done("src", "characterize")
+
+	# Second run does not copy again and finishes the remaining stages.
+	sip_processor = make_processor()
+	copy = mocker.patch("processor.copy_tree")
+	mocker.patch("processor.run_command", side_effect=fake_brunnhilde())
+	sip_processor.run()
+
+	assert not copy.called
+	for stage in ("characterize", "dfxml", "checksum", "permissions", "describe"):
+		assert sip_processor.journal.done("src", stage)
+	assert is_non_zero_file(os.path.join(DEST_DIR, "src", "metadata", "checksum.md5"))
+	assert is_non_zero_file(os.path.join(OUTPUT_DIR, "description.csv"))
+	assert sip_processor.journal.summaries()["src"]["file_count"] == 1
+
+
+def test_existing_sip_is_not_replaced(tmp_path):
+	OUTPUT_DIR = str(tmp_path / "output")
+	DEST_DIR = tmp_path / "dest"
+	os.makedirs(OUTPUT_DIR)
+	(DEST_DIR / "src" / "objects").mkdir(parents=True)
+	(DEST_DIR / "src" / "objects" / "other.txt").write_bytes(b"other")
+	source = tmp_path / "src"
+	source.mkdir()
+	(source / "a.txt").write_bytes(b"hello")
+	events = []
+	sip_processor = SIPProcessor(
+		dirs_to_process=[str(source)],
+		destination=str(DEST_DIR),
+		bag_files=False,
+		scan_for_pii=False,
+		output_dir=OUTPUT_DIR,
+		report=events.append,
+		shared_siegfried=False,
+	)
+
+	assert sip_processor.run() == 1
+	assert [event["status"] for event in events if event["event"] == "sip_done"] == ["failed"]
+	assert os.listdir(str(DEST_DIR / "src" / "objects")) == ["other.txt"]
+	assert "src" not in sip_processor.journal.sips
+
+	# A SIP described by this job from another folder of the same name is
+	# not skipped as done.
+	other = str(tmp_path / "other" / "src")
+	sip_processor.journal.begin("src", other)
+	sip_processor.journal.record("src", "describe")
+	events.clear()
+
+	assert sip_processor.run() == 1
+	assert [event["status"] for event in events if event["event"] == "sip_done"] == ["failed"]
+	assert other in [event for event in events if event["event"] == "error"][0]["message"]
+	assert events[-1]["failed"] == 1
+
+
+@pytest.mark.parametrize("max_pending_bytes, overlap", [(None, True), (1, False)])
+def test_pipeline(tmp_path, mocker, max_pending_bytes, overlap):
+	DEST_DIR = tmp_path / "dest"
+	DEST_DIR.mkdir()
+	for name in ("a", "b"):
+		(tmp_path / "src" / name).mkdir(parents=True)
+		(tmp_path / "src" / name / "file.txt").write_bytes(b"data")
+	b_copied = threading.Event()
+	b_copied_during_a = []
+	copy_tree = processor.copy_tree
+
+	def fake_copy_tree(source, *args):
+		records = copy_tree(source, *args)
+		if source.endswith("b"):
+			b_copied.set()
+		return records
+
+	def wait_for_b(cmd):
+		if "/a/" in cmd[-2]:
+			b_copied_during_a.append(b_copied.wait(1 if overlap else 0.2))
+
+	mocker.patch("processor.copy_tree", side_effect=fake_copy_tree)
+	mocker.patch("processor.run_command", side_effect=fake_brunnhilde(before=wait_for_b))
+	sip_processor = SIPProcessor(
+		dirs_to_process=[str(tmp_path / "src" / "a"), str(tmp_path / "src" / "b")],
+		destination=str(DEST_DIR),
+		bag_files=False,
+		scan_for_pii=False,
+		output_dir=str(tmp_path),
+		shared_siegfried=False,
+		max_pending_bytes=max_pending_bytes,
+	)
+
+	assert sip_processor.run() == 0
+	assert b_copied_during_a == [overlap]
+
+
+def test_stage_metrics(tmp_path):
+	OUTPUT_DIR = tmp_path / "output"
+	DEST_DIR = tmp_path / "dest"
+	for dir_ in (OUTPUT_DIR, DEST_DIR):
+		dir_.mkdir()
+	source = tmp_path / "src"
+	source.mkdir()
+	(source / "a.txt").write_bytes(b"hello")
+	events = []
+	sip_processor = SIPProcessor(
+		dirs_to_process=[str(source)],
+		destination=str(DEST_DIR),
+		bag_files=False,
+		scan_for_pii=False,
+		output_dir=str(OUTPUT_DIR),
+		report=events.append,
+	)
+
+	sip_processor.run()
+
+	with open(str(OUTPUT_DIR / "metrics.jsonl")) as f:
+		entries = [json.loads(line) for line in f]
+	stages = [entry["stage"] for entry in entries]
+	assert stages == ["copy", "characterize", "dfxml", "checksum", "permissions"]
+	copy = entries[0]
+	assert copy["sip"] == "src"
+	assert (copy["files"], copy["bytes"]) == (1, 5)
+	assert copy["seconds"] >= 0
+	assert entries[1]["exit_code"] == 0
+	assert entries[1]["max_rss_kb"] > 0
+	preflight = events[0]
+	assert (preflight["event"], preflight["files"], preflight["bytes"]) == ("preflight", 1, 5)
+	progress = [event for event in events if event["event"] == "progress"]
+	assert progress[-1]["bytes_done"] == progress[-1]["bytes_total"] == 5
+	assert progress[-1]["eta_seconds"] == 0
+	stage_events = [
+		(event["stage"], event["state"]) for event in events if event["event"] == "stage"
+	]
+	assert stage_events[:3] == [("copy", "started"), ("copy", "finished"), ("characterize", "started")]
+	assert stage_events[-1] == ("permissions", "finished")
+	summary = events[-1]["stages"]
+	assert summary["copy"]["sips"] == 1
+	assert summary["copy"]["bytes"] == 5
+
+
+def test_run_command(tmp_path):
+	script = tmp_path / "it's a script.py"
+	script.write_text(
+		"import sys, time\n"
+		"print('x' * 1000000)\n"
+		"print('bad input', file=sys.stderr)\n"
+		"time.sleep(float(sys.argv[1]))\n"
+		"sys.exit(int(sys.argv[2]))\n"
+	)
+
+	exit_code, max_rss_kb = processor.run_command([sys.executable, str(script), "0", "0"])
+	assert exit_code == 0
+	assert max_rss_kb > 0
+
+	with pytest.raises(processor.CommandError) as err:
+		processor.run_command([sys.executable, str(script), "0", "3"])
+	assert err.value.exit_code == 3
+	assert str(err.value).endswith("exited with code 3: bad input")
+
+	with pytest.raises(processor.CommandError, match="timed out"):
+		processor.run_command([sys.executable, str(script), "30", "0"], timeout=0.5)
+
+	stop = threading.Event()
+	threading.Timer(0.5, stop.set).start()
+	start = time.monotonic()
+	with pytest.raises(processor.CommandError, match="was stopped") as err:
+		processor.run_command([sys.executable, str(script), "30", "0"], stop=stop)
+	assert err.value.exit_code < 0
+	assert time.monotonic() - start < 10
+
+	with pytest.raises(processor.CommandError, match="could not be started"):
+		processor.run_command([str(tmp_path / "missing")])
+
+
+def test_failed_pii_scan_stops_sip(tmp_path, mocker):
+	OUTPUT_DIR = tmp_path / "output"
+	OUTPUT_DIR.mkdir()
+	source = tmp_path / "src"
+	source.mkdir()
+	(source / "a.txt").write_bytes(b"hello")
+	brunnhilde_started = threading.Event()
+	brunnhilde_stopped = []
+
+	def fake_run_command(cmd, timeout=None, stop=None):
+		if cmd[0] == "bulk_extractor":
+			brunnhilde_started.wait(10)
+			raise processor.CommandError(cmd, "exited with code 1", 1)
+		# Brunnhilde runs until the failed scan stops it.
+		brunnhilde_started.set()
+		brunnhilde_stopped.append(stop.wait(10))
+		raise processor.CommandError(cmd, "was stopped", -15)
+
+	mocker.patch("processor.run_command", side_effect=fake_run_command)
+	events = []
+	sip_processor = SIPProcessor(
+		dirs_to_process=[str(source)],
+		destination=str(tmp_path / "dest"),
+		bag_files=False,
+		scan_for_pii=True,
+		output_dir=str(OUTPUT_DIR),
+		report=events.append,
+		shared_siegfried=False,
+	)
+
+	assert sip_processor.run() == 1
+	assert brunnhilde_stopped == [True]
+	errors = [event for event in events if event["event"] == "error"]
+	assert errors == [
+		{"event": "error", "sip": "src", "message": "bulk_extractor exited with code 1"}
+	]
+	assert not sip_processor.journal.done("src", "characterize")
+	assert not os.path.exists(
+		str(tmp_path / "dest" / "src" / "metadata" / "submissionDocumentation" / "dfxml.xml")
+	)
+
+
+def test_failed_sip_does_not_stop_batch(tmp_path, mocker):
+	OUTPUT_DIR = tmp_path / "output"
+	DEST_DIR = OUTPUT_DIR / "SIPs"
+	DEST_DIR.mkdir(parents=True)
+	sources = []
+	for name in ("full", "ok"):
+		source = tmp_path / name
+		source.mkdir()
+		(source / "a.txt").write_bytes(b"hello")
+		sources.append(str(source))
+	write_dfxml = processor.write_dfxml
+
+	def fake_write_dfxml(records, dfxml_path):
+		if "full" in dfxml_path:
+			raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC), dfxml_path)
+		return write_dfxml(records, dfxml_path)
+
+	mocker.patch("processor.write_dfxml", side_effect=fake_write_dfxml)
+	mocker.patch("processor.run_command", side_effect=fake_brunnhilde())
+	events = []
+	sip_processor = SIPProcessor(
+		dirs_to_process=sources,
+		destination=str(DEST_DIR),
+		bag_files=False,
+		scan_for_pii=False,
+		output_dir=str(OUTPUT_DIR),
+		workers=3,
+		report=events.append,
+		shared_siegfried=False,
+	)
+
+	assert sip_processor.run() == 1
+	statuses = {event["sip"]: event["status"] for event in events if event["event"] == "sip_done"}
+	assert statuses == {"full": "failed", "ok": "ok"}
+	errors = [event for event in events if event["event"] == "error"]
+	assert [event["sip"] for event in errors] == ["full"]
+	assert "No space left on device" in sip_processor.journal.sips["full"]["error"]
+	assert events[-1]["event"] == "done" and events[-1]["failed"] == 1
+	with open(str(OUTPUT_DIR / "description.csv")) as f:
+		assert [row[1] for row in csv.reader(f)][1:] == ["ok"]
+
+
+def test_verify_objects(tmp_path):
+	objects = tmp_path / "objects" / "src"
+	objects.mkdir(parents=True)
+	for name in ("ok.txt", "changed.txt", "manifest.txt", "extra.txt"):
+		(objects / name).write_bytes(name.encode())
+	md5 = {
+		"src/" + name: hashlib.md5(name.encode()).hexdigest()
+		for name in ("ok.txt", "changed.txt", "manifest.txt", "missing.txt")
+	}
+	expected = dict(md5, **{"src/changed.txt": "0" * 32})
+	manifest_path = tmp_path / "checksum.md5"
+	manifest_path.write_text(
+		"".join(
+			"{}  ../objects/{}\n".format(digest, path)
+			for path, digest in dict(md5, **{"src/manifest.txt": "1" * 32}).items()
+		)
+	)
+	manifest = processor.read_manifest(str(manifest_path), "../objects")
+
+	problems = processor.verify_objects(
+		expected, manifest, str(tmp_path / "objects"), "md5", workers=2
+	)
+
+	assert [(problem["path"], problem["problem"]) for problem in problems] == [
+		("src/changed.txt", "manifest mismatch"),
+		("src/changed.txt", "mismatch"),
+		("src/extra.txt", "not in source"),
+		("src/manifest.txt", "manifest mismatch"),
+		("src/missing.txt", "missing"),
+	]
+	report_path = str(tmp_path / "fixity" / "src.csv")
+	processor.write_fixity_report(problems, report_path)
+	assert processor.read_fixity_report(report_path) == problems
+	assert processor.read_fixity_report(str(tmp_path / "none.csv")) is None
+
+
+@pytest.mark.parametrize("bag_files", [False, True])
+def test_verify_stage(tmp_path, mocker, bag_files):
+	OUTPUT_DIR = tmp_path / "output"
+	DEST_DIR = OUTPUT_DIR / "SIPs"
+	DEST_DIR.mkdir(parents=True)
+	source = tmp_path / "src"
+	source.mkdir()
+	(source / "a.txt").write_bytes(b"hello")
+	(source / "b.txt").write_bytes(b"world")
+	copy_tree = processor.copy_tree
+
+	def fake_copy_tree(source, destination, *args):
+		records = copy_tree(source, destination, *args)
+		# Damage one file after it was copied.
+		with open(os.path.join(destination, "b.txt"), "wb") as f:
+			f.write(b"w0rld")
+		return records
+
+	mocker.patch("processor.copy_tree", side_effect=fake_copy_tree)
+	mocker.patch("processor.run_command", side_effect=fake_brunnhilde(count=2))
+	events = []
+	sip_processor = SIPProcessor(
+		dirs_to_process=[str(source)],
+		destination=str(DEST_DIR),
+		bag_files=bag_files,
+		scan_for_pii=False,
+		output_dir=str(OUTPUT_DIR),
+		report=events.append,
+		shared_siegfried=False,
+		verify=True,
+	)
+	sip_processor.run()
+
+	problems = processor.read_fixity_report(str(OUTPUT_DIR / "fixity" / "src.csv"))
+	assert [(problem["path"], problem["problem"]) for problem in problems] == [
+		("src/b.txt", "mismatch")
+	]
+	assert any(event["event"] == "warning" for event in events)
+	with open(str(OUTPUT_DIR / "description.csv")) as f:
+		row = list(csv.reader(f))[1]
+	assert row[CSV_HEADERS.index("General note (optional)")] == (
+		"Fixity check failed for 1 file(s); see {}.".format(os.path.join("fixity", "src.csv"))
+	)
+	with open(str(OUTPUT_DIR / "summary.jsonl")) as f:
+		assert json.loads(f.readline())["fixity_problems"] == 1
+
+
+def test_cancel(tmp_path, mocker):
+	OUTPUT_DIR = tmp_path / "output"
+	DEST_DIR = OUTPUT_DIR / "SIPs"
+	DEST_DIR.mkdir(parents=True)
+	source = tmp_path / "src"
+	source.mkdir()
+	for name in ("a.txt", "b.txt"):
+		(source / name).write_bytes(b"hello")
+	events = []
+	sip_processor = SIPProcessor(
+		dirs_to_process=[str(source)],
+		destination=str(DEST_DIR),
+		bag_files=False,
+		scan_for_pii=False,
+		output_dir=str(OUTPUT_DIR),
+		report=events.append,
+		shared_siegfried=False,
+	)
+	tool_stopped = []
+
+	def fake_run_command(cmd, timeout=None, stop=None):
+		sip_processor.cancel()
+		tool_stopped.append(stop.is_set())
+		raise processor.CommandError(cmd, "was stopped", -15)
+
+	mocker.patch("processor.run_command", side_effect=fake_run_command)
+
+	assert sip_processor.run() == 0
+	assert tool_stopped == [True]
+	sip_done = [event for event in events if event["event"] == "sip_done"]
+	assert [event["status"] for event in sip_done] == ["cancelled"]
+	incomplete = sip_done[0]["incomplete"]
+	assert os.path.dirname(incomplete) == str(OUTPUT_DIR / "incomplete")
+	assert os.path.isfile(os.path.join(incomplete, "objects", "src", "a.txt"))
+	assert os.listdir(str(DEST_DIR)) == []
+	assert "src" not in sip_processor.journal.sips
+	assert events[-1]["cancelled"] == 1
+
+	# Copies stop before the next file.
+	stop = threading.Event()
+	stop.set()
+	with pytest.raises(processor.Cancelled):
+		copy_tree(str(source), str(tmp_path / "copy"), "src", stop=stop)
+	assert os.listdir(str(tmp_path / "copy")) == []
+
+	# So do scans and verification.
+	with pytest.raises(processor.Cancelled):
+		list(scan_tree(str(source), "src", stop=stop))
+	with pytest.raises(processor.Cancelled):
+		processor.verify_objects({"src/a.txt": ""}, {}, str(tmp_path), "md5", stop=stop)
+
+
+def test_siegfried_request_can_be_stopped():
+	with socket.socket() as sock:
+		# The server accepts connections but never answers.
+		sock.bind(("localhost", 0))
+		sock.listen()
+		server = siegfried.SiegfriedServer.__new__(siegfried.SiegfriedServer)
+		server.address = "localhost:{}".format(sock.getsockname()[1])
+		stop = threading.Event()
+		threading.Timer(0.2, stop.set).start()
+		start = time.monotonic()
+
+		with pytest.raises(OSError, match="was stopped"):
+			server.identify_tree("/tmp", stop=stop)
+		with pytest.raises(OSError, match="timed out"):
+			server.identify_tree("/tmp", timeout=0.2)
+		assert time.monotonic() - start < 5
+
+
+def test_shared_siegfried_uses_cache(tmp_path, mocker):
+	source = tmp_path / "src"
+	source.mkdir()
+	(source / "a.txt").write_bytes(b"hello")
+	server = mocker.Mock()
+
+	header = "filename,filesize,modified,errors,md5,namespace,id,format,version,mime,basis,warning\n"
+	row = "{},5,2020-01-01T00:00:00Z,,{},pronom,x-fmt/111,Plain Text File,,text/plain,,\n"
+
+	def identify(path, workers=1, **kwargs):
+		return header + row.format(
+			os.path.join(path, "src", "a.txt"), hashlib.md5(b"hello").hexdigest()
+		)
+
+	def identify_paths(paths, workers=1, **kwargs):
+		return header + "".join(
+			row.format(path, hashlib.md5(b"hello").hexdigest()) for path in paths
+		)
+
+	server.identify_tree.side_effect = identify
+	server.identify_paths.side_effect = identify_paths
+	mocker.patch("processor.SiegfriedServer.start", return_value=server)
+	commands = []
+
+	def check_sf_input(cmd):
+		commands.append(cmd)
+		sf_input = cmd[cmd.index("--csv") + 1]
+		with open(sf_input) as f:
+			assert os.path.join("objects", "src", "a.txt") in f.read()
+
+	mocker.patch("processor.run_command", side_effect=fake_brunnhilde(before=check_sf_input))
+
+	for run in ("first", "second", "third"):
+		if run == "third":
+			(source / "b.txt").write_bytes(b"hello")
+		(tmp_path / run / "SIPs").mkdir(parents=True)
+		SIPProcessor(
+			dirs_to_process=[str(source)],
+			destination=str(tmp_path / run / "SIPs"),
+			bag_files=False,
+			scan_for_pii=False,
+			output_dir=str(tmp_path / run),
+			cache_path=str(tmp_path / "cache.sqlite"),
+		).run()
+
+	# Only the file added before the third run is identified again.
+	assert server.identify_tree.call_count == 1
+	assert server.identify_paths.call_args[0][0] == [
+		str(tmp_path / "third" / "SIPs" / "src" / "objects" / "src" / "b.txt")
+	]
+	with open(str(tmp_path / "third" / "SIPs" / "src" / "metadata" / "submissionDocumentation" / "brunnhilde" / "siegfried.csv")) as f:
+		assert [row["filename"].rsplit(os.sep, 1)[1] for row in csv.DictReader(f)] == ["a.txt", "b.txt"]
+	assert server.close.call_count == 3
+	assert len(commands) == 3
+	assert not [name for name in os.listdir(str(tmp_path / "second")) if name.startswith("src-")]
+
+
+def test_run_closes_cache(tmp_path, mocker):
+	source = tmp_path / "src"
+	source.mkdir()
+	(source / "a.txt").write_bytes(b"hello")
+	(tmp_path / "SIPs").mkdir()
+	mocker.patch("processor.run_command", side_effect=fake_brunnhilde())
+	close = mocker.spy(DigestCache, "close")
+	processor = SIPProcessor(
+		dirs_to_process=[str(source)],
+		destination=str(tmp_path / "SIPs"),
+		bag_files=False,
+		scan_for_pii=False,
+		shared_siegfried=False,
+		output_dir=str(tmp_path),
+		cache_path=str(tmp_path / "cache.sqlite"),
+	)
+	processor.run()
+
+	assert close.call_count == 1
+	assert processor.cache is None
+
+def test_benchmark_corpus_is_reproducible(tmp_path):
+	def snapshot(root):
+		files = {}
+		for dirpath, dirnames, filenames in os.walk(str(root)):
+			for name in filenames:
+				path = os.path.join(dirpath, name)
+				with open(path, "rb") as f:
+					digest = hashlib.md5(f.read()).hexdigest()
+				files[os.path.relpath(path, str(root))] = (digest, os.stat(path).st_mtime)
+		return files
+
+	first = benchmark.build_corpus("deep", str(tmp_path / "first"), scale=0.1)
+	second = benchmark.build_corpus("deep", str(tmp_path / "second"), scale=0.1)
+
+	assert [os.path.basename(path) for path in first] == ["deep_000"]
+	assert len(snapshot(tmp_path / "first")) == 50
+	assert snapshot(tmp_path / "first") == snapshot(tmp_path / "second")
+
+
+def test_benchmark_stats(tmp_path):
+	entry = benchmark.run_stats(str(tmp_path), 2500, 0, trace_memory=True)
+
+	assert (entry["benchmark"], entry["files"]) == ("stats", 2500)
+	assert entry["seconds"] >= 0 and "peak_mb" in entry
+	assert os.listdir(str(tmp_path)) == []
+
+
+def test_cli(tmp_path, mocker, capfd):
+	DEST_DIR = tmp_path / "dest"
+	manifest = tmp_path / "manifest.txt"
+	for name in ("a", "b"):
+		(tmp_path / "src" / name).mkdir(parents=True)
+	manifest.write_text("# comment\n{}\n".format(tmp_path / "src" / "b"))
+
+	def fake_create_sip(self, source, destination, bag_files, scan_for_pii):
+		_write_fake_sip(destination, os.path.basename(source), "2018-01-01T00:00:00Z")
+
+	mocker.patch.object(SIPProcessor, "create_sip", fake_create_sip)
+	status = cli.main(
+		[str(tmp_path / "src" / "a*"), "--manifest", str(manifest), str(DEST_DIR)]
+	)
+
+	assert status == 0
+	events = [json.loads(line) for line in capfd.readouterr().out.splitlines()]
+	sips = [event["sip"] for event in events if event["event"] == "sip_done"]
+	assert sorted(sips) == ["a", "b"]
+	assert events[-1] == {
+		"event": "done",
+		"total": 2,
+		"failed": 0,
+		"cancelled": 0,
+		"stages": {},
+	}
+	assert is_non_zero_file(str(DEST_DIR / "description.csv"))
+
+
+def test_cli_does_not_import_qt():
+	output = subprocess.check_output(
+		[sys.executable, "-c", "import sys, cli; print('PyQt5' in sys.modules)"]
+	)
+	assert output.strip() == b"False"
+
+
+def test_checkable_dir_model(tmp_path):
+	from PyQt5.QtCore import Qt
+	from PyQt5.QtWidgets import QApplication
+
+	app = QApplication.instance() or QApplication([])
+	for path in ("a/a1/a2", "a/b1", "b", "c/c1"):
+		(tmp_path / path).mkdir(parents=True)
+	model = CheckableDirModel()
+	model.setRootPath(str(tmp_path))
+
+	def check(path, value):
+		index = model.index(str(tmp_path / path))
+		assert model.setData(index, value, Qt.CheckStateRole)
+
+	check("a/a1", Qt.Checked)
+	check("a", Qt.Checked)
+	check("c/c1", Qt.Checked)
+
+	assert model.checks == {str(tmp_path / "a"): Qt.Checked, str(tmp_path / "c" / "c1"): Qt.Checked}
+	assert model.checkState(model.index(str(tmp_path / "a" / "a1" / "a2"))) == Qt.Checked
+	assert model.checkState(model.index(str(tmp_path / "b"))) == Qt.Unchecked
+	assert model.checkedPaths() == [str(tmp_path / "a"), str(tmp_path / "c" / "c1")]
+
+	# Folders inside a checked folder are part of its SIP and cannot be unchecked.
+	index = model.index(str(tmp_path / "a" / "a1"))
+	assert not model.flags(index) & Qt.ItemIsUserCheckable
+	assert not model.setData(index, Qt.Unchecked, Qt.CheckStateRole)
+	assert model.checkState(index) == Qt.Checked
+	assert model.checkedPaths() == [str(tmp_path / "a"), str(tmp_path / "c" / "c1")]
+	assert model.flags(model.index(str(tmp_path / "b"))) & Qt.ItemIsUserCheckable
+
+
+def test_cancel_button_before_start():
+	from PyQt5.QtWidgets import QApplication
+
+	app = QApplication.instance() or QApplication([])
+	window = ProcessorApp()
+
+	assert not window.cancelBtn.isEnabled()
+	window.cancel_processing()
+	assert window.processBtn.isEnabled()
+
+
+def test_gui_reports_failed_sips(tmp_path, mocker):
+	from PyQt5.QtWidgets import QApplication
+
+	app = QApplication.instance() or QApplication([])
+	window = ProcessorApp()
+	window.get_thread = SIPThread([], str(tmp_path), False, False, str(tmp_path))
+	window.get_thread.report(
+		{"event": "error", "sip": "photos", "message": "brunnhilde.py exited with code 1: Traceback\nOSError: disk full"}
+	)
+	window.get_thread.report({"event": "warning", "message": "Fixity check found 1 problem(s) in letters"})
+	window.get_thread.report(
+		{"event": "done", "total": 2, "failed": 1, "cancelled": 0, "stages": {}}
+	)
+	window.update_stage({"event": "stage", "sip": "letters", "stage": "pii", "state": "started"})
+	assert window.status.text() == "0 of 0 SIPs done. Running: pii (letters). 1 SIP(s) failed. 1 warning(s)."
+	window.update_stage({"event": "stage", "sip": "letters", "stage": "pii", "state": "finished"})
+	window.sips_total = 2
+	window.increment_progress_bar("letters")
+	assert window.status.text().startswith("1 of 2 SIPs done.")
+	warning = mocker.patch("main.QMessageBox.warning")
+
+	window.done()
+
+	message = warning.call_args[0][2]
+	assert message.startswith("Process complete, but 1 of 2 SIP(s) failed:")
+	assert "photos: OSError: disk full" in message
+	assert "Warnings:\nFixity check found 1 problem(s) in letters" in message
+	assert window.status.text() == "Completed with 1 failed SIP(s)"
+	del window.get_thread